@@ -0,0 +1,310 @@
+'''
+Micro-benchmarks of the interpreters
+'''
+
+# Python imports
+import time
+
+# clara imports
+from .interpreter import Budget, getlanginter
+from .model import Const, Op, Var
+from .parser import getlangparser
+from .py_interpreter import BINARY_OPERATORS, UNARY_OPERATORS, PyInterpreter
+from .py_interpreter import eargs
+
+
+# Small loop-heavy programs (name -> (lang, code, inputs))
+PROGRAMS = {
+    'sum': ('cpp', '''
+int main() {
+    int n, s = 0;
+    cin >> n;
+    for (int i = 0; i < n; i++) {
+        s = s + i % 7;
+    }
+    cout << s;
+    return 0;
+}
+''', [2000]),
+    'nested': ('cpp', '''
+int main() {
+    int n, c = 0;
+    cin >> n;
+    for (int i = 0; i < n; i++) {
+        for (int j = 0; j < i; j++) {
+            if ((i + j) % 3 == 0) {
+                c = c + 1;
+            }
+        }
+    }
+    cout << c;
+    return 0;
+}
+''', [60]),
+    'while': ('cpp', '''
+int main() {
+    int n, k = 0;
+    cin >> n;
+    while (n != 1) {
+        if (n % 2 == 0) {
+            n = n / 2;
+        } else {
+            n = 3 * n + 1;
+        }
+        k = k + 1;
+    }
+    cout << k;
+    return 0;
+}
+''', [77031]),
+}
+
+
+# Arithmetic-heavy programs (name -> (lang, code, inputs))
+ARITH = {
+    'gcd': ('cpp', '''
+int main() {
+    int n, s = 0;
+    cin >> n;
+    for (int i = 1; i <= n; i++) {
+        int a = i * 7 + 3, b = i % 13 + 1;
+        while (b != 0) {
+            int t = a % b;
+            a = b;
+            b = t;
+        }
+        s = s + a;
+    }
+    cout << s;
+    return 0;
+}
+''', [600]),
+    'newton': ('cpp', '''
+int main() {
+    int n;
+    double s = 0.0;
+    cin >> n;
+    for (int i = 1; i <= n; i++) {
+        double x = i * 1.0, r = x / 2.0 + 1.0;
+        for (int k = 0; k < 8; k++) {
+            r = (r + x / r) / 2.0;
+        }
+        s = s + r;
+    }
+    cout << s;
+    return 0;
+}
+''', [300]),
+    'mixed': ('cpp', '''
+int main() {
+    int n, c = 0;
+    double f = 0.5;
+    cin >> n;
+    for (int i = 0; i < n; i++) {
+        f = f * 1.5 - i;
+        if (f > 100.0 || f < -100.0 && i % 2 == 0) {
+            f = f / 7;
+            c = c + 1;
+        }
+    }
+    cout << c;
+    return 0;
+}
+''', [2000]),
+}
+
+
+# Recursive programs calling functions with the same arguments many times
+# (name -> (lang, code, inputs))
+RECURSIVE = {
+    'fib': ('cpp', '''
+int fib(int n) {
+    if (n < 2) return n;
+    return fib(n - 1) + fib(n - 2);
+}
+int main() {
+    int n;
+    cin >> n;
+    cout << fib(n);
+    return 0;
+}
+''', [16]),
+    'binom': ('cpp', '''
+int binom(int n, int k) {
+    if (k == 0 || k == n) return 1;
+    return binom(n - 1, k - 1) + binom(n - 1, k);
+}
+int main() {
+    int n;
+    cin >> n;
+    cout << binom(n, n / 2);
+    return 0;
+}
+''', [14]),
+}
+
+
+# Python expressions (name -> expression), evaluated in memory PYMEM
+PYEXPRS = {
+    'arith': Op('Add', Op('Mult', Var('x'), Const('3')),
+                Op('Mod', Op('USub', Var('y')), Const('7'))),
+    'compare': Op('Not', Op('Lt', Op('Sub', Var('x'), Var('y')),
+                            Op('FloorDiv', Var('x'), Const('2')))),
+    'member': Op('In', Op('BitAnd', Var('x'), Const('15')), Var('l')),
+}
+
+PYMEM = {'x': 41, 'y': 5, 'l': list(range(10))}
+
+
+def timeit(fncs, repeat=5):
+    '''
+    Best (lowest) wall-clock time of repeat calls to each of fncs (calls are
+    interleaved, so that noise affects all of them alike)
+    '''
+
+    best = [None for _ in fncs]
+    for _ in range(repeat):
+        for i, fnc in enumerate(fncs):
+            start = time.perf_counter()
+            fnc()
+            t = time.perf_counter() - start
+            if best[i] is None or t < best[i]:
+                best[i] = t
+    return best
+
+
+def bench_consts(programs, repeat=5, names=None):
+    '''
+    Compares runs with constants decoded once against runs decoding them on
+    every evaluation; returns a list of (name, evaluated expressions,
+    time decoded once, time decoded every time)
+    '''
+
+    res = []
+    for name in sorted(names or programs):
+        lang, code, ins = programs[name]
+        prog = getlangparser(lang).parse_code(code)
+        inter = getlanginter(lang)
+
+        I1 = inter(timeout=None)
+        I2 = inter(timeout=None)
+        I2.execute_Const = lambda c, mem, I2=I2: I2.decode_const(c.value)
+
+        trace = I1.run(prog, ins=ins)
+        t1, t2 = timeit([lambda: I1.run(prog, ins=ins),
+                         lambda: I2.run(prog, ins=ins)], repeat)
+
+        res.append((name, trace.used.evals, t1, t2))
+
+    return res
+
+
+def print_bench_consts(programs, repeat=5, names=None):
+    print('%-10s %8s %10s %10s %9s' % (
+        'program', 'evals', 'decoded', 'each time', 'speedup'))
+    for name, evals, t1, t2 in bench_consts(programs, repeat, names):
+        print('%-10s %8d %9.3fs %9.3fs %8.2fx' % (
+            name, evals, t1, t2, t2 / t1))
+
+
+def bench(programs, repeat=5, names=None):
+    '''
+    Runs programs (see PROGRAMS); returns a list of
+    (name, steps, evaluated expressions, time)
+    '''
+
+    res = []
+    for name in sorted(names or programs):
+        lang, code, ins = programs[name]
+        prog = getlangparser(lang).parse_code(code)
+        I = getlanginter(lang)(timeout=None)
+
+        trace = I.run(prog, ins=ins)
+        t, = timeit([lambda: I.run(prog, ins=ins)], repeat)
+
+        res.append((name, trace.used.steps, trace.used.evals, t))
+
+    return res
+
+
+def print_bench(programs, repeat=5, names=None):
+    print('%-10s %8s %8s %10s %12s' % (
+        'program', 'steps', 'evals', 'time', 'evals/s'))
+    for name, steps, evals, t in bench(programs, repeat, names):
+        print('%-10s %8d %8d %9.3fs %12.0f' % (
+            name, steps, evals, t, evals / t))
+
+
+def bench_memo(programs, repeat=5, names=None):
+    '''
+    Compares runs with memoized calls of pure functions against runs
+    without memoization; returns a list of (name, steps, time memoized,
+    time not memoized)
+    '''
+
+    unlimited = Budget(steps=None, iters=None, evals=None)
+
+    res = []
+    for name in sorted(names or programs):
+        lang, code, ins = programs[name]
+        prog = getlangparser(lang).parse_code(code)
+        inter = getlanginter(lang)
+
+        I1 = inter(timeout=None, budget=unlimited, memo=True)
+        I2 = inter(timeout=None, budget=unlimited)
+
+        trace = I1.run(prog, ins=ins)
+        t1, t2 = timeit([lambda: I1.run(prog, ins=ins),
+                         lambda: I2.run(prog, ins=ins)], repeat)
+
+        res.append((name, trace.used.steps, t1, t2))
+
+    return res
+
+
+def print_bench_memo(programs, repeat=5, names=None):
+    print('%-10s %8s %10s %10s %9s' % (
+        'program', 'steps', 'memo', 'no memo', 'speedup'))
+    for name, steps, t1, t2 in bench_memo(programs, repeat, names):
+        print('%-10s %8d %9.3fs %9.3fs %8.2fx' % (
+            name, steps, t1, t2, t2 / t1))
+
+
+def bench_pyops(repeat=5, n=20000, names=None):
+    '''
+    Compares evaluation (n times) of expressions (see PYEXPRS) by generated
+    operators of the Python interpreter against operators wrapped by eargs;
+    returns a list of (name, time generated, time eargs)
+    '''
+
+    # Operators as they were before: methods wrapped by eargs
+    methods = {}
+    for ops in (UNARY_OPERATORS, BINARY_OPERATORS):
+        for name, fnc in ops.items():
+            methods['execute_%s' % (name,)] = eargs(
+                lambda self, *args, fnc=fnc: fnc(*args))
+    EargsInterpreter = type('EargsInterpreter', (PyInterpreter,), methods)
+
+    I1 = PyInterpreter(timeout=None)
+    I2 = EargsInterpreter(timeout=None)
+
+    def evaluate(I, expr):
+        for _ in range(n):
+            I.execute(expr, PYMEM)
+
+    res = []
+    for name in sorted(names or PYEXPRS):
+        expr = PYEXPRS[name]
+        assert I1.execute(expr, PYMEM) == I2.execute(expr, PYMEM)
+        t1, t2 = timeit([lambda: evaluate(I1, expr),
+                         lambda: evaluate(I2, expr)], repeat)
+        res.append((name, t1, t2))
+
+    return res
+
+
+def print_bench_pyops(repeat=5, n=20000, names=None):
+    print('%-10s %10s %10s %9s' % ('expression', 'generated', 'eargs',
+                                   'speedup'))
+    for name, t1, t2 in bench_pyops(repeat, n, names):
+        print('%-10s %9.3fs %9.3fs %8.2fx' % (name, t1, t2, t2 / t1))
@@ -3,10 +3,13 @@ C interpreter
 '''
 
 # Python imports
+import codecs
 import math
+import operator
 import sys
 
 # clara.py imports
+from .common import InputStream
 from .interpreter import Interpreter, addlanginter, RuntimeErr, UndefValue
 from .model import Var, EOF
 
@@ -43,33 +46,52 @@ def libcall(*args):
     return dec
 
 
+# Binary operations (except short-circuit '&&' and '||') on numeric values
+BINARY_FNCS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.truediv,
+    '%': operator.mod,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '^': operator.xor,
+    '&': operator.and_,
+    '|': operator.or_,
+}
+
+
 class CInterpreter(Interpreter):
     BINARY_OPS = {'+', '-', '*', '/', '%', '<', '<=', '>', '>=', '==', '!=',
                   '^', '&', '!', '&&', '||'}
 
     UNARY_OPS = {'!', '-', '+'}
 
-    def execute_Const(self, c, mem):
+    def decode_const(self, value):
 
         # Undef
-        if c.value == '?':
+        if value == '?':
             return UndefValue
 
         # EOF
-        if c.value == 'EOF':
+        if value == 'EOF':
             return -1
 
-        if c.value == "endl":
+        if value == "endl":
             return "\n";
 
         # String
-        if len(c.value) >= 2 and c.value[0] == c.value[-1] == '"':
-            return str(c.value[1:-1])
+        if len(value) >= 2 and value[0] == value[-1] == '"':
+            return str(value[1:-1])
 
         # Char
-        if len(c.value) >= 3 and c.value[0] == c.value[-1] == "'":
+        if len(value) >= 3 and value[0] == value[-1] == "'":
             try:
-                ch = c.value[1:-1].decode('string_escape')
+                ch = codecs.decode(value[1:-1], 'unicode_escape')
                 if len(ch) == 1:
                     return ord(ch)
             except ValueError:
@@ -77,17 +99,17 @@ class CInterpreter(Interpreter):
 
         # Integer
         try:
-            return int(c.value)
+            return int(value)
         except ValueError:
             pass
 
         # Float
         try:
-            return float(c.value)
+            return float(value)
         except ValueError:
             pass
 
-        assert False, 'Unknown constant: %s' % (c.value,)
+        assert False, 'Unknown constant: %s' % (value,)
 
     def execute_UnaryOp(self, op, x, mem):
 
@@ -121,40 +143,18 @@ class CInterpreter(Interpreter):
 
         y = self.tonumeric(self.execute(y, mem))
 
-        x, y = self.togreater(x, y)
-
-        if op == '+':
-            res = x + y
-        elif op == '-':
-            res = x - y
-        elif op == '*':
-            res = x * y
-        elif op == '/':
-            res = x / y
-        elif op == '%':
-            res = x % y
-        elif op == '==':
-            res = x == y
-        elif op == '!=':
-            res = x != y
-        elif op == '<':
-            res = x < y
-        elif op == '<=':
-            res = x <= y
-        elif op == '>':
-            res = x > y
-        elif op == '>=':
-            res = x >= y
-        elif op == '^':
-            res = x ^ y
-        elif op == '&':
-            res = x & y
-        elif op == '|':
-            res = x | y
-        else:
+        fnc = BINARY_FNCS.get(op)
+        if fnc is None:
             assert False, 'Unknown binary op: %s' % (op,)
 
-        return res
+        # Fast path: both int or both float (nothing to convert)
+        tx = type(x)
+        if tx is type(y) and (tx is int or tx is float):
+            return fnc(x, y)
+
+        x, y = self.togreater(x, y)
+
+        return fnc(x, y)
 
     def execute_cast(self, c, mem):
 
@@ -247,7 +247,20 @@ class CInterpreter(Interpreter):
         return math.exp(x)
 
     def tonumeric(self, v):
-        if isinstance(v, list):
+
+        # Fast paths (same as below: ints and bools are compared with
+        # True/False by value, so also 0.0 and 1.0 become ints)
+        t = type(v)
+        if t is int:
+            return v
+        if t is float:
+            if v == 1.0 or v == 0.0:
+                return 1 if v else 0
+            return v
+        if t is bool:
+            return 1 if v else 0
+
+        if isinstance(v, (list, InputStream)):
             return len(v) > 0
 
         if v in [True, False]:
@@ -268,36 +281,57 @@ class CInterpreter(Interpreter):
 
         return x, y
 
-    def convert(self, val, t):
-
-        if isinstance(val, UndefValue):
-            return val
-
-        if val == EOF:
-            return EOF
+    def makeconverter(self, t):
 
         if t == 'int':
-            if val in [True, False]:
-                val = 1 if val else 0
-            return int(val)
+            def conv(val):
+                if type(val) is int:
+                    return val
+                if isinstance(val, UndefValue):
+                    return val
+                if val == EOF:
+                    return EOF
+                return int(val)
+            return conv
 
         if t == 'float':
-            if val in [True, False]:
-                val = 1.0 if val else 0.0
-            return float(val)
+            def conv(val):
+                if type(val) is float:
+                    return val
+                if isinstance(val, UndefValue):
+                    return val
+                if val == EOF:
+                    return EOF
+                return float(val)
+            return conv
 
         if t == 'char':
-            if val in [True, False]:
-                val = 1 if val else 0
-            return int(val) % 128
+            def conv(val):
+                if type(val) is int:
+                    return val % 128
+                if isinstance(val, UndefValue):
+                    return val
+                if val == EOF:
+                    return EOF
+                return int(val) % 128
+            return conv
 
         if t.endswith('[]'):
-            st = t[:-2]
-            if isinstance(val, list):
-                return [x if x is None else self.convert(x, st) for x in val]
-            raise RuntimeErr("Expected list, got '%s'" % (val,))
-
-        return val
+            elem = self.getconverter(t[:-2])
+
+            def conv(val):
+                if isinstance(val, UndefValue):
+                    return val
+                if val == EOF:
+                    return EOF
+                if not isinstance(val, list):
+                    raise RuntimeErr("Expected list, got '%s'" % (val,))
+                if elem is None:
+                    return list(val)
+                return [x if x is None else elem(x) for x in val]
+            return conv
+
+        return None
 
 
 addlanginter('c', CInterpreter)
@@ -9,8 +9,9 @@ from clara.feedback import FeedGen, Feedback
 from clara.feedback_repair import RepairFeedback
 from clara.interpreter import getlanginter
 from clara.matching import Matching
-from clara.model import expr_to_dict
+from clara.model import ExprFactory, expr_to_dict
 from clara.parser import getlangparser
+from clara.ranking import SpecRanker
 from clara.repair import Repair
 
 VERBOSE = 1
@@ -18,7 +19,8 @@ VERBOSE = 1
 
 class Clara(object):
 
-    def __init__(self, inputs, lang='cpp'):
+    def __init__(self, inputs, lang='cpp', budget=None, memo=False,
+                 pool=None):
         self.lang = lang
         self.parser = getlangparser(self.lang)
         self.interpreter = getlanginter(self.lang)
@@ -27,22 +29,35 @@ class Clara(object):
         self.clusters_dir = './clusters'
         self.models = []
         self.max_cost = 100
+        self.timeout = 60  # Timeout (in seconds) of repair with each spec
+        self.earlystop = None  # Stop at the first repair of at most this cost
+        self.topk = None  # Repair only with this many most promising specs
+        self.budget = budget  # Budget of each execution (None for default)
+        self.memo = memo  # Memoize calls of pure functions in executions
+        self.pool = pool  # Pool running executions on inputs (None: serially)
+        self.ranker = SpecRanker(self.interpreter, ins=[self.inputs],
+                                 entryfnc=self.entry_function,
+                                 budget=self.budget)
         global VERBOSE
 
     def eval(self):
-        inter = self.interpreter(entryfnc=self.entry_function)
+        inter = self.interpreter(entryfnc=self.entry_function,
+                                 budget=self.budget, memo=self.memo)
         # print(self.models[0])
         trace = inter.run(self.models[0], args=None, ins=self.inputs)
         return trace
 
+    def process_code(self, code, name=None):
+        model = self.parser.parse_code(code)
+        model.name = name
+        return model
+
     def process_source(self, src):
         with open(src, 'r', encoding="utf-8") as f:
             # print("processing", src)
             code = f.read()
             # print("processed", src)
-        model = self.parser.parse_code(code)
-        model.name = src
-        return model
+        return self.process_code(code, src)
 
     def process_sources(self, sources):
         self.models = []
@@ -51,7 +66,8 @@ class Clara(object):
             self.models.append(model)
 
     def match(self):
-        matching = Matching()
+        matching = Matching(budget=self.budget, memo=self.memo,
+                            pool=self.pool)
         m = matching.match_programs(self.models[0], self.models[1],
                                     self.interpreter, ins=[self.inputs], entryfnc=self.entry_function)
         if m:
@@ -60,8 +76,8 @@ class Clara(object):
             return False
 
     def cluster(self):
-        M = Matching()
-        C = Clustering(M)
+        M = Matching(budget=self.budget, memo=self.memo, pool=self.pool)
+        C = Clustering(M, factory=ExprFactory())
         existing = []
         shutil.rmtree(self.clusters_dir, ignore_errors=True)
         os.mkdir(self.clusters_dir)
@@ -114,13 +130,13 @@ class Clara(object):
                         "expr": expr_to_dict(fnc.getexpr(loc, var)),
                         "src": None,
                     })
-                    for expr in set(rex[loc][var]):
+                    for expr, src in rex[loc][var].items():
                         exprs.append({
                             "fnc": fnc.name,
                             "loc": loc,
                             "var": var,
                             "expr": expr_to_dict(expr),
-                            "src": expr.src,
+                            "src": src,
                         })
 
         ext = '.' + self.lang
@@ -129,7 +145,8 @@ class Clara(object):
             json.dump(exprs, f, indent=2)
 
     def repair(self):
-        R = Repair(verbose=False)
+        R = Repair(timeout=self.timeout, verbose=False, budget=self.budget,
+                   memo=self.memo, pool=self.pool)
         r = R.repair(self.models[0], self.models[1], self.interpreter, ins=[self.inputs], entryfnc=self.entry_function)
 
         if r:
@@ -140,14 +157,23 @@ class Clara(object):
         else:
             print('No repair!')
 
+    def generate_feedback(self, impl, specs, feedgen=None):
+        if feedgen is None:
+            feedgen = FeedGen(feedmod=RepairFeedback, timeout=self.timeout,
+                              earlystop=self.earlystop, budget=self.budget)
+
+        if self.topk:
+            specs = self.ranker.topk(impl, specs, self.topk)
+
+        return feedgen.generate(
+            impl, specs, self.interpreter, ins=[self.inputs], ignoreret=True,
+            entryfnc=self.entry_function)
+
     def feedback(self):
-        F = FeedGen(feedmod=RepairFeedback)
         impl = self.models[-1]
         specs = self.models[:-1]
 
-        feed = F.generate(
-            impl, specs, self.interpreter, ins=[self.inputs], ignoreret=True,
-            entryfnc=self.entry_function)
+        feed = self.generate_feedback(impl, specs)
 
         if feed.status == Feedback.STATUS_REPAIRED:
             if self.max_cost > 0 and feed.cost > self.max_cost:
@@ -159,3 +185,23 @@ class Clara(object):
             print(feed.error)
         else:
             print(feed.statusstr())
+
+    def rank_recall(self, specs, impls, ks):
+        '''
+        Recall of top-k spec selection on held-out (incorrect) programs,
+        w.r.t. the spec selected by repairing with all specs
+        '''
+
+        F = FeedGen(feedmod=RepairFeedback, timeout=self.timeout,
+                    budget=self.budget)
+        cases = []
+        for impl in impls:
+            feed = F.generate(
+                impl, specs, self.interpreter, ins=[self.inputs],
+                ignoreret=True, entryfnc=self.entry_function)
+            if feed.status == Feedback.STATUS_REPAIRED:
+                cases.append((impl, specs, feed.spec.name))
+        if F.pool is not None:
+            F.pool.terminate()
+
+        return self.ranker.recall(cases, ks), len(cases)
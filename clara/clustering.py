@@ -4,8 +4,9 @@ Clustering stuff (a convenience layer over matching)
 
 class Clustering(object):
 
-    def __init__(self, matching):
+    def __init__(self, matching, factory=None):
         self.matching = matching
+        self.factory = factory  # ExprFactory (to share repair expressions)
 
     def extract_exprs(self, cprog, prog, sm, m):
         fncs1 = cprog.getfncs()
@@ -30,21 +31,23 @@ class Clustering(object):
                 for (v1, v2) in list(fm.items()):
                     expr_exist = fnc1.getexpr(loc1, v1)
                     expr = fnc2.getexpr(loc2, v2)
-                    expr_new = expr.replace_vars(fm_trans)
+                    if self.factory is not None:
+                        expr_new = self.factory.replace_vars(expr, fm_trans)
+                    else:
+                        expr_new = expr.replace_vars(fm_trans)
                     if expr_exist == expr_new:
                         continue
                     
                     if loc1 not in rex:
                         rex[loc1] = {}
                     if v1 not in rex[loc1]:
-                        rex[loc1][v1] = []
+                        rex[loc1][v1] = {}  # expr -> name of its program
                         
                     if expr_new in rex[loc1][v1]:
                         continue
-                    expr_new.src = prog.name
 
                     # print(loc1, v1, expr_new)
-                    rex[loc1][v1].append(expr_new)
+                    rex[loc1][v1][expr_new] = prog.name
                     anymod = True
 
         return anymod
@@ -56,12 +59,18 @@ class Clustering(object):
         clusters = list(existing)
         modset = set()
 
+        # Clusters by structure (only those can match)
+        bystruct = {}
+        for i, cprog in enumerate(clusters):
+            bystruct.setdefault(cprog.structkey(), []).append(i)
+
         # Go through all programs
         for prog in progs:
             
             # Check whether prog matches any of the existing clusters
             found = False
-            for i, cprog in enumerate(clusters):
+            for i in bystruct.get(prog.structkey(), []):
+                cprog = clusters[i]
                 m = self.matching.match_programs(
                     cprog, prog, inter, ins=ins, args=args, entryfnc=entryfnc)
                 if not m: continue
@@ -78,6 +87,7 @@ class Clustering(object):
             if not found:
                 ex = prog.name.rsplit('.')[-1]
                 prog.new_name = 'c%d.%s' % (len(clusters)+1, ex)
+                bystruct.setdefault(prog.structkey(), []).append(len(clusters))
                 clusters.append(prog)
 
         new = clusters[len(existing):]
@@ -106,6 +106,198 @@ def cleanstr(s):
     return s
 
 
+class InputStream(object):
+    '''
+    Input (value of $in): immutable buffer with a position, that behaves
+    (e.g., equality and repr) as a list of the remaining inputs, where
+    tail of an exhausted stream is [EOF]. Head, tail and copies are O(1)
+    and all streams from the same input share the buffer.
+    '''
+
+    __slots__ = ('buf', 'pos', 'eof')
+
+    def __init__(self, buf, pos=0, eof=False):
+        self.buf = buf if isinstance(buf, tuple) else tuple(buf)
+        self.pos = pos
+        self.eof = eof  # Read past the end (so the value is [EOF])
+
+    def tolist(self):
+        if self.eof:
+            return [EOF]
+        return list(self.buf[self.pos:])
+
+    def exhausted(self):
+        '''
+        True if the value is [] or [EOF]
+        '''
+
+        n = len(self.buf) - self.pos
+        return self.eof or n == 0 or (n == 1 and self.buf[self.pos] == EOF)
+
+    def head(self):
+        '''
+        Next input (or EOF)
+        '''
+
+        if self.exhausted():
+            return EOF
+        return self.buf[self.pos]
+
+    def tail(self):
+        '''
+        Stream without the next input
+        '''
+
+        if self.exhausted():
+            return InputStream(self.buf, len(self.buf), True)
+        return InputStream(self.buf, self.pos + 1)
+
+    def __len__(self):
+        return 1 if self.eof else len(self.buf) - self.pos
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __getitem__(self, i):
+        return self.tolist()[i]
+
+    def __eq__(self, other):
+        if isinstance(other, InputStream):
+            if (self.buf is other.buf and self.pos == other.pos
+                    and self.eof == other.eof):
+                return True
+            return self.tolist() == other.tolist()
+        if isinstance(other, list):
+            return self.tolist() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None  # As a list
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (InputStream, (self.buf, self.pos, self.eof))
+
+
+class OutputBuffer(object):
+    '''
+    Output (value of $out): append-only chain of chunks, where appending
+    shares the existing chunks, so that all snapshots of the output in a
+    trace share their common prefix. Besides length, each buffer keeps a
+    polynomial digest of its (UTF-8 encoded) content, which doesn't depend
+    on how the content was split into chunks, so buffers are compared and
+    hashed without joining the chunks.
+    '''
+
+    __slots__ = ('prev', 'chunk', 'length', 'size', 'digest')
+
+    # Modulus of the digest (base is 256, i.e., a byte)
+    MOD = (1 << 127) - 1
+
+    def __init__(self, chunk='', prev=None):
+        data = chunk.encode('utf-8', 'surrogatepass')
+        self.prev = prev
+        self.chunk = chunk
+        if prev is None:
+            self.length = len(chunk)
+            self.size = len(data)
+            self.digest = int.from_bytes(data, 'big') % self.MOD
+        else:
+            self.length = prev.length + len(chunk)
+            self.size = prev.size + len(data)
+            self.digest = (prev.digest * pow(256, len(data), self.MOD)
+                           + int.from_bytes(data, 'big')) % self.MOD
+
+    def append(self, s):
+        if not s:
+            return self
+        return OutputBuffer(s, self)
+
+    def __add__(self, other):
+        if isinstance(other, (str, OutputBuffer)):
+            return self.append(str(other))
+        return NotImplemented
+
+    def __str__(self):
+        chunks = []
+        buf = self
+        while buf is not None:
+            chunks.append(buf.chunk)
+            buf = buf.prev
+        chunks.reverse()
+        return ''.join(chunks)
+
+    def __len__(self):
+        return self.length
+
+    def __eq__(self, other):
+        '''
+        Size and digest only rule out different buffers quickly, equal ones
+        are compared by content (except for their shared prefix):
+
+        >>> s = ' ' * 126  # Same digest (byte weights repeat every 127)
+        >>> OutputBuffer('a' + s + 'b') == OutputBuffer('b' + s + 'a')
+        False
+        >>> OutputBuffer('ab').append('c') == OutputBuffer('a').append('bc')
+        True
+        '''
+
+        if isinstance(other, OutputBuffer):
+            if self is other:
+                return True
+            if self.size != other.size or self.digest != other.digest:
+                return False
+
+            # Chunks up to the last shared one (both lengths are then equal)
+            a, b = self, other
+            ta, tb = [], []
+            while a is not b:
+                if b is None or (a is not None and a.length >= b.length):
+                    ta.append(a.chunk)
+                    a = a.prev
+                else:
+                    tb.append(b.chunk)
+                    b = b.prev
+            ta.reverse()
+            tb.reverse()
+            return ''.join(ta) == ''.join(tb)
+        if isinstance(other, str):
+            return self.length == len(other) and str(self) == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    # Consistent only among buffers (not with an equal str)
+    def __hash__(self):
+        return hash((self.size, self.digest))
+
+    def __repr__(self):
+        return repr(str(self))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        # Joined (pickling a long chain would recurse too deep)
+        return (OutputBuffer, (str(self),))
+
+
 def equals(v1, v2):
     '''
     Different equality
@@ -113,6 +305,17 @@ def equals(v1, v2):
     (mainly because different representations of two "same" floats)
     '''
 
+    # Input streams (same position in the same buffer is a quick check)
+    if isinstance(v1, InputStream) or isinstance(v2, InputStream):
+        if (isinstance(v1, InputStream) and isinstance(v2, InputStream)
+                and v1.buf is v2.buf and v1.pos == v2.pos
+                and v1.eof == v2.eof):
+            return True
+        if isinstance(v1, InputStream):
+            v1 = v1.tolist()
+        if isinstance(v2, InputStream):
+            v2 = v2.tolist()
+
     # List and tuples
     if ((isinstance(v1, list) and isinstance(v2, list))
             or (isinstance(v1, tuple) and isinstance(v2, tuple))):
@@ -154,10 +357,15 @@ def print_trace(trace):
     for tup in trace:
         mem = tup[2]
         print(tup[1], "::", mem_filter(mem))
+    used = getattr(trace, 'used', None)
+    if used is not None:
+        print('used:', used)
     print('\n\n')
 
 
 def evaluate_as_boolean(value):
+    if isinstance(value, InputStream):
+        value = value.tolist()
     if isinstance(value, list) and len(value) > 0 and value[0] == EOF:
         return False
     return not not value
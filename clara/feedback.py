@@ -6,7 +6,7 @@ Feedback generation from repair on multiple specifications
 import time
 import traceback
 
-from multiprocessing import Pool
+from multiprocessing import Pool, RawValue, TimeoutError
 
 # External libs
 from zss import Node
@@ -17,6 +17,26 @@ from .model import Var, isprimed, unprime, prime
 from .repair import Repair, Timeout, StructMismatch
 
 
+# Specifications preloaded into the current process (see FeedGen.preload)
+_specs = {}
+
+# Number of the active FeedGen.generate call (shared with the pool workers),
+# tasks of any other call are cancelled
+_current = None
+
+
+def init_worker(specs, current):
+    '''
+    Pool initializer:
+    - keeps specs in (worker) memory, so that tasks only need to carry their
+      names
+    - remembers the shared number of the active call (for cancelling tasks)
+    '''
+    global _specs, _current
+    _specs = {spec.name: spec for spec in specs}
+    _current = current
+
+
 class Feedback(object):
     '''
     Feedback result on a single specification
@@ -27,14 +47,20 @@ class Feedback(object):
     STATUS_STRUCT = 17
     STATUS_TIMEOUT = 18
     STATUS_ERROR = 19
+    STATUS_CANCELLED = 20
 
     def __init__(self, impl, spec, inter, timeout=None, verbose=False,
                  ins=None, args=None, ignoreio=False, ignoreret=False,
                  cleanstrings=False,
-                 entryfnc=None, allowsuboptimal=True, feedmod=RepairFeedback):
+                 entryfnc=None, allowsuboptimal=True, feedmod=RepairFeedback,
+                 preloaded=False, gen=None, budget=None):
 
         self.impl = impl
         self.spec = spec
+        self.preloaded = preloaded
+        self.gen = gen
+        self.idx = None  # Index among the tasks of a FeedGen
+        self.budget = budget
         self.timeout = timeout
         self.verbose = verbose
         self.inter = inter
@@ -58,6 +84,25 @@ class Feedback(object):
 
         self.start = time.time()
 
+    def __getstate__(self):
+        # Preloaded specs are sent (to and from a pool) only by their name
+        state = dict(self.__dict__)
+        if self.preloaded:
+            state['spec'] = self.spec.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.preloaded:
+            self.spec = _specs[self.spec]
+
+    def cancelled(self):
+        '''
+        Checks whether this task belongs to a call that is no longer active
+        '''
+        return (_current is not None and self.gen is not None
+                and _current.value != self.gen)
+
     def generate(self):
 
         # Time spent waiting in pool queue
@@ -67,7 +112,9 @@ class Feedback(object):
         # Create a repair object
         R = Repair(timeout=self.timeout, verbose=self.verbose,
                    allowsuboptimal=self.allowsuboptimal,
-                   cleanstrings=self.cleanstrings)
+                   cleanstrings=self.cleanstrings,
+                   cachetrace=self.preloaded, cancelled=self.cancelled,
+                   budget=self.budget)
 
         try:
             # Try generating a repair
@@ -101,9 +148,13 @@ class Feedback(object):
             self.error = 'no struct'
 
         except Timeout:
-            # Timeout occured
-            self.status = self.STATUS_TIMEOUT
-            self.error = 'timeout'
+            # Cancelled (from FeedGen) or timeout occured
+            if self.cancelled():
+                self.status = self.STATUS_CANCELLED
+                self.error = 'cancelled'
+            else:
+                self.status = self.STATUS_TIMEOUT
+                self.error = 'timeout'
 
     def treesize(self, t):
         '''
@@ -185,6 +236,8 @@ class Feedback(object):
             return 'timeout'
         elif self.status == self.STATUS_ERROR:
             return 'error'
+        elif self.status == self.STATUS_CANCELLED:
+            return 'cancelled'
         else:
             return 'unknown<%s>' % (self.status,)
 
@@ -198,6 +251,10 @@ def run_feedback(f):
     '''
     Helper function that runs a single process
     '''
+    if f.cancelled():
+        f.status = Feedback.STATUS_CANCELLED
+        f.error = 'cancelled'
+        return f
     try:
         f.generate()
     except Exception as ex:
@@ -211,16 +268,138 @@ class FeedGen(object):
     Feedback generator from multiple specs
     - manages multiple processes
     - selectes one feedback among generated ones
+
+    With earlystop set (to a cost), specs are processed as they complete
+    (most similar first) and the remaining ones are cancelled once a repair
+    of at most that cost is found; callback is called on each result as it
+    arrives.
+
+    With timeout set, tasks still running KILL_GRACE seconds after their
+    timeout are reported as timed out, and the pool (with the stuck workers)
+    is killed and replaced by a new one.
     '''
 
+    KILL_GRACE = 5
+
     def __init__(self, verbose=False, timeout=False, poolsize=None,
-                 allowsuboptimal=True, pool=None, feedmod=RepairFeedback):
+                 allowsuboptimal=True, pool=None, feedmod=RepairFeedback,
+                 earlystop=None, callback=None, budget=None):
         self.verbose = verbose
         self.timeout = timeout
         self.poolsize = poolsize
         self.pool = pool
         self.allowsuboptimal = allowsuboptimal
         self.feedmod = feedmod
+        self.earlystop = earlystop
+        self.callback = callback
+        self.budget = budget
+        self.preloaded = set()
+        self.preloadspecs = []
+        self.current = RawValue('i', 0)
+
+    def newpool(self):
+        '''
+        Creates a new pool (with the preloaded specs)
+        '''
+        self.pool = Pool(processes=self.poolsize, initializer=init_worker,
+                         initargs=(self.preloadspecs, self.current))
+
+    def preload(self, specs):
+        '''
+        Creates a (warm) pool that keeps specs in memory of every worker, so
+        that subsequent calls to generate do not have to send them again
+        '''
+
+        if self.pool is not None:
+            self.pool.terminate()
+
+        init_worker(specs, self.current)
+        self.preloadspecs = list(specs)
+        self.preloaded = {spec.name for spec in specs}
+        self.newpool()
+
+    def estimate(self, impl, spec, implstruct=None):
+        '''
+        Cheap estimate of how (dis)similar spec is to impl (lower is better):
+        specs with a different structure cannot be repaired at all, otherwise
+        differences in the number of variables and expressions are compared
+        '''
+
+        if implstruct is None:
+            implstruct = impl.getstruct()
+        if spec.getstruct() != implstruct:
+            return (1, 0, 0)
+
+        nvars, nexprs = 0, 0
+        for fnc1 in spec.getfncs():
+            fnc2 = impl.getfnc(fnc1.name)
+            nvars += abs(len(fnc1.getvars()) - len(fnc2.getvars()))
+            nexprs += abs(sum(fnc1.numexprs(loc) for loc in fnc1.locs())
+                          - sum(fnc2.numexprs(loc) for loc in fnc2.locs()))
+        return (0, nvars, nexprs)
+
+    def collect(self, tasks, ordered=True):
+        '''
+        Yields results of tasks (in order of tasks or as they complete),
+        killing the stuck ones (see timeout); when closed before all results
+        are collected, cancels all remaining tasks
+        '''
+
+        if ordered:
+            results = self.pool.imap(run_feedback, tasks)
+        else:
+            results = self.pool.imap_unordered(run_feedback, tasks)
+
+        deadline = None
+        if self.timeout:
+            deadline = time.time() + self.timeout + self.KILL_GRACE
+
+        pending = {task.idx: task for task in tasks}
+        try:
+            while pending:
+                try:
+                    if deadline is None:
+                        res = results.next()
+                    else:
+                        res = results.next(max(0, deadline - time.time()))
+                except TimeoutError:
+                    break
+                del pending[res.idx]
+                if self.callback:
+                    self.callback(res)
+                yield res
+
+            # Kill stuck workers (by replacing the whole pool)
+            if pending:
+                self.pool.terminate()
+                self.newpool()
+
+            for idx in sorted(pending):
+                res = pending.pop(idx)
+                res.status = Feedback.STATUS_TIMEOUT
+                res.error = 'timeout (killed)'
+                if self.callback:
+                    self.callback(res)
+                yield res
+
+        finally:
+            self.current.value += 1
+
+    def ascompleted(self, tasks):
+        '''
+        Yields results of tasks as they complete, until a repair with cost at
+        most earlystop is found (then all remaining tasks are cancelled)
+        '''
+
+        results = self.collect(tasks, ordered=False)
+        try:
+            for res in results:
+                yield res
+                if (res.status == Feedback.STATUS_REPAIRED
+                        and res.cost <= self.earlystop):
+                    return
+        finally:
+            results.close()
 
     def generate(self, impl, specs, inter, ins=None, args=None,
                  entryfnc='main', ignoreio=False, ignoreret=False,
@@ -241,7 +420,17 @@ class FeedGen(object):
 
         # Create a pool
         if self.pool is None:
-            self.pool = Pool(processes=self.poolsize)
+            self.newpool()
+
+        # Number of this call (tasks of earlier calls are no longer needed)
+        self.current.value += 1
+        gen = self.current.value
+
+        # Most promising specs first
+        if self.earlystop is not None:
+            implstruct = impl.getstruct()
+            specs = sorted(specs,
+                           key=lambda s: self.estimate(impl, s, implstruct))
 
         # Creates list of tasks, for each spec one
         tasks = [
@@ -250,13 +439,28 @@ class FeedGen(object):
                 ins=self.ins, args=self.args, ignoreio=self.ignoreio,
                 ignoreret=self.ignoreret, entryfnc=self.entryfnc,
                 cleanstrings=self.cleanstrings,
-                allowsuboptimal=self.allowsuboptimal, feedmod=self.feedmod)
+                allowsuboptimal=self.allowsuboptimal, feedmod=self.feedmod,
+                preloaded=spec.name in self.preloaded, gen=gen,
+                budget=self.budget)
             for spec in specs]
+        for idx, task in enumerate(tasks):
+            task.idx = idx
 
         # Process all tasks
-        results = self.pool.map(run_feedback, tasks)
+        if self.earlystop is None:
+            results = self.collect(tasks)
+        else:
+            results = self.ascompleted(tasks)
+        try:
+            return self.select(results)
+        finally:
+            results.close()
+
+    def select(self, results):
+        '''
+        Selects one feedback among results
+        '''
 
-        # Go through results
         feedback = None
         feedbacks = []
         for res in results:
@@ -265,10 +469,12 @@ class FeedGen(object):
                 return res
 
             # Return or remember timeout results
-            # (depending if suboptimal feedback is allowed or not)
+            # (depending if suboptimal feedback is allowed or not); those
+            # without any (suboptimal) repair go after all repairs
             if res.status == Feedback.STATUS_TIMEOUT:
                 if self.allowsuboptimal:
-                    feedbacks.append(((res.cost, res.spec.name), res))
+                    cost = res.cost if res.cost >= 0 else float('inf')
+                    feedbacks.append(((cost, res.spec.name), res))
                 else:
                     return res
 
@@ -280,6 +486,10 @@ class FeedGen(object):
             elif res.status == Feedback.STATUS_REPAIRED:
                 feedbacks.append(((res.cost, res.spec.name), res))
 
+            # Skip cancelled
+            elif res.status == Feedback.STATUS_CANCELLED:
+                continue
+
             else:
                 # Should not happen :)
                 assert False, 'unknown status: %s' % (res.statusstr(),)
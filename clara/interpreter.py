@@ -3,13 +3,20 @@ Common interpreter stuff
 '''
 
 # Python imports
+import mmap
+import pickle
+import struct
+import tempfile
 import time
 
+from array import array
+from bisect import bisect_right
 from copy import deepcopy
 
 # clara.py imports
-from .common import UnknownLanguage, evaluate_as_boolean
-from .model import Program, VAR_IN, VAR_OUT, VAR_RET, VAR_COND, EOF
+from .common import InputStream, OutputBuffer, UnknownLanguage
+from .common import evaluate_as_boolean
+from .model import Program, Op, Var, VAR_IN, VAR_OUT, VAR_RET, VAR_COND, EOF
 from .model import prime, unprime, isprimed
 
 
@@ -17,6 +24,78 @@ class RuntimeErr(Exception):
     pass
 
 
+class BudgetExceeded(RuntimeErr):
+    '''
+    Execution exceeded its budget (see Budget)
+    '''
+
+
+class Budget(object):
+    '''
+    Limits of a single execution (None for unlimited):
+    - steps - number of visited locations
+    - iters - number of loop iterations (taken back edges)
+    - evals - number of evaluated expressions (assignments)
+    - depth - depth of (nested) function calls
+    - spill - number of values of a trace kept in memory, the rest is
+      spilled to a (memory-mapped) temporary file (None to keep all)
+    Also used to report the amounts actually used (see Trace).
+    '''
+
+    def __init__(self, steps=100000, iters=None, evals=1000000, depth=None,
+                 spill=None):
+        self.steps = steps
+        self.iters = iters
+        self.evals = evals
+        self.depth = depth
+        self.spill = spill
+
+    def __repr__(self):
+        if self.spill is not None:
+            return '<Budget steps=%s iters=%s evals=%s depth=%s spill=%s>' % (
+                self.steps, self.iters, self.evals, self.depth, self.spill)
+        return '<Budget steps=%s iters=%s evals=%s depth=%s>' % (
+            self.steps, self.iters, self.evals, self.depth)
+
+
+class CallRequest(Exception):
+    '''
+    Call of a function from an expression (see Interpreter.execute_Function)
+    '''
+
+    def __init__(self, fnc, mem, memokey=None):
+        self.fnc = fnc
+        self.mem = mem
+        self.memokey = memokey
+
+
+class Frame(object):
+    '''
+    Execution of a function: current location (index in the CFG) and
+    expression there, memory, and for the expression (if it made calls):
+    results of the calls (by their number, with the number of the next
+    call), the pending call, and input and output before its evaluation
+    '''
+
+    __slots__ = ('fnc', 'cfg', 'mem', 'i', 'j', 'ncalls', 'results',
+                 'pending', 'saved', 'depth', 'memokey', 'start', 'height')
+
+    def __init__(self, fnc, mem):
+        self.fnc = fnc
+        self.cfg = fnc.cfg()
+        self.mem = mem
+        self.i = self.cfg.init
+        self.j = 0
+        self.ncalls = 0
+        self.results = {}
+        self.pending = None
+        self.saved = None
+        self.depth = 1  # Number of frames on the stack (up to this one)
+        self.memokey = None  # Key in the memo table (if memoized)
+        self.start = None  # Start (in the log of steps) and used budget
+        self.height = 0  # Depth of calls made from this frame
+
+
 class UndefValue(object):
 
     def __eq__(self, other):
@@ -30,21 +109,534 @@ def isundef(x):
     return isinstance(x, UndefValue)
 
 
+class Absent(object):
+    '''
+    Value (in a column of a Trace) of a variable missing from the memory
+    '''
+
+    def __repr__(self):
+        return '<absent>'
+
+    def __reduce__(self):
+        return 'ABSENT'
+
+
+ABSENT = Absent()
+
+
+class SpillFile(object):
+    '''
+    Temporary storage of spilled values of a trace: blocks are written to
+    (sparse, already removed) temporary files of at least REGION bytes, each
+    memory-mapped once, so that blocks are read back without copying
+    '''
+
+    REGION = 16 << 20
+
+    def __init__(self):
+        self.region = None
+        self.pos = 0
+
+    def write(self, data):
+        '''
+        Appends a block of data; returns a (read-only) memoryview of it
+        '''
+
+        n = len(data)
+        if self.region is None or self.pos + n > len(self.region):
+            size = max(self.REGION, n)
+            with tempfile.TemporaryFile() as f:
+                f.truncate(size)
+                self.region = memoryview(mmap.mmap(f.fileno(), size))
+            self.pos = 0
+
+        start = self.pos
+        self.region[start:start + n] = data
+        self.pos = start + n + (-n % 8)
+        return self.region[start:start + n].toreadonly()
+
+
+class SpilledSegment(object):
+    '''
+    Consecutive values of a column of a Trace in a SpillFile, laid out as
+    (n is the number of values, parts are padded to 8 bytes):
+    - n steps (int64)
+    - n tags (uint8), kind of each value
+    - n slots (int64 or float64), the value itself, index of a value kept in
+      memory, or offset (high 32 bits) and length of its pickle
+    - pickles
+    Values sharing their parts between steps (input and output) are kept in
+    memory, and others (e.g., lists) are pickled.
+    '''
+
+    (TAG_ABSENT, TAG_INT, TAG_FLOAT, TAG_BOOL, TAG_NONE, TAG_UNDEF, TAG_KEPT,
+     TAG_PICKLE) = range(8)
+
+    def __init__(self, block, offset, n, kept):
+        block = memoryview(block)
+        tagsoff = offset + 8 * n
+        slotsoff = tagsoff + n + (-n % 8)
+        picklesoff = slotsoff + 8 * n
+
+        self.steps = block[offset:tagsoff].cast('q')
+        self.tags = block[tagsoff:tagsoff + n]
+        self.ints = block[slotsoff:picklesoff].cast('q')
+        self.floats = block[slotsoff:picklesoff].cast('d')
+        self.pickles = block[picklesoff:]
+        self.kept = kept
+        self.data = block[offset:]
+
+    def __reduce__(self):
+        # Pickled with its data (e.g., to be sent from a worker of a pool),
+        # so it's kept in memory once unpickled
+        end = 0
+        for i, tag in enumerate(self.tags):
+            if tag == self.TAG_PICKLE:
+                slot = self.ints[i]
+                end = max(end, (slot >> 32) + (slot & 0xffffffff))
+        size = len(self.data) - len(self.pickles) + end
+        return (SpilledSegment,
+                (bytes(self.data[:size]), 0, len(self.tags), self.kept))
+
+    @classmethod
+    def encode(cls, steps, values, kept):
+        n = len(steps)
+        tags = bytearray(n + (-n % 8))
+        slots = bytearray(8 * n)
+        pickles = bytearray()
+
+        for i, val in enumerate(values):
+            t = type(val)
+            if val is ABSENT:
+                tag = cls.TAG_ABSENT
+            elif t is int and -(1 << 63) <= val < (1 << 63):
+                tag = cls.TAG_INT
+                struct.pack_into('q', slots, 8 * i, val)
+            elif t is float:
+                tag = cls.TAG_FLOAT
+                struct.pack_into('d', slots, 8 * i, val)
+            elif t is bool:
+                tag = cls.TAG_BOOL
+                struct.pack_into('q', slots, 8 * i, val)
+            elif val is None:
+                tag = cls.TAG_NONE
+            elif t is UndefValue:
+                tag = cls.TAG_UNDEF
+            elif t is InputStream or t is OutputBuffer:
+                tag = cls.TAG_KEPT
+                struct.pack_into('q', slots, 8 * i, len(kept))
+                kept.append(val)
+            else:
+                tag = cls.TAG_PICKLE
+                data = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+                struct.pack_into('q', slots, 8 * i,
+                                 (len(pickles) << 32) | len(data))
+                pickles += data
+            tags[i] = tag
+
+        pickles += bytes(-len(pickles) % 8)
+        return array('q', steps).tobytes() + tags + slots + pickles
+
+    def __len__(self):
+        return len(self.tags)
+
+    def __getitem__(self, i):
+        tag = self.tags[i]
+        if tag == self.TAG_INT:
+            return self.ints[i]
+        if tag == self.TAG_FLOAT:
+            return self.floats[i]
+        if tag == self.TAG_ABSENT:
+            return ABSENT
+        if tag == self.TAG_BOOL:
+            return bool(self.ints[i])
+        if tag == self.TAG_NONE:
+            return None
+        if tag == self.TAG_UNDEF:
+            return UndefValue()
+        if tag == self.TAG_KEPT:
+            return self.kept[self.ints[i]]
+        slot = self.ints[i]
+        start = slot >> 32
+        return pickle.loads(self.pickles[start:start + (slot & 0xffffffff)])
+
+
+class ChainSeq(object):
+    '''
+    Read-only concatenation of sequences
+    '''
+
+    def __init__(self, parts):
+        self.parts = [part for part in parts if len(part)]
+        self.starts = []
+        n = 0
+        for part in self.parts:
+            self.starts.append(n)
+            n += len(part)
+        self.len = n
+
+    def __len__(self):
+        return self.len
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.len
+        if not 0 <= i < self.len:
+            raise IndexError('sequence index out of range')
+        j = bisect_right(self.starts, i) - 1
+        return self.parts[j][i - self.starts[j]]
+
+
+class Trace(object):
+    '''
+    Trace of an execution: sequence of steps (fnc, loc, mem), with the budget
+    used. Steps are stored by columns:
+    - fncs and locs - function (index into fncnames) and location of each step
+    - columns - for each variable (primed or not) only the steps at which its
+      value changed, and those values (ABSENT when not in the memory)
+    - order - keys of the memory of each step (index into keys)
+    Indexing or iterating gives (fnc, loc, mem), where mem is a lazy
+    (read-only) view of the columns (see TraceMem).
+    When more than spill values are kept in memory, they are moved to
+    a temporary file (see SpilledSegment), from which they are read back
+    through a memory map.
+    '''
+
+    # Values of these types are compared by equality (others by identity)
+    # when deciding whether a value changed
+    SCALARS = (int, str, bool, UndefValue, type(None))
+
+    def __init__(self, steps=(), spill=None):
+        self.fncnames = []
+        self.fncindex = {}
+        self.fncs = array('l')
+        self.locs = array('l')
+
+        self.keys = []
+        self.keyindex = {}
+        self.order = array('l')
+
+        self.columns = {}
+        self.last = {}  # Current value of each variable
+
+        self.spill = spill
+        self.inmem = 0  # Number of values in columns (kept in memory)
+        self.spillfile = None
+        self.spilled = {}  # Spilled segments of each column (in order)
+        self.kept = []  # Values of spilled segments that are kept in memory
+
+        self.used = None
+
+        for step in steps:
+            self.append(step)
+
+    def __getstate__(self):
+        # Spill file is not pickled (spilled segments are, see
+        # SpilledSegment), further values are spilled to a new one
+        state = dict(self.__dict__)
+        state['spillfile'] = None
+        return state
+
+    def append(self, step):
+        fnc, loc, mem = step
+        k = len(self.locs)
+
+        f = self.fncindex.get(fnc)
+        if f is None:
+            f = self.fncindex[fnc] = len(self.fncnames)
+            self.fncnames.append(fnc)
+        self.fncs.append(f)
+        self.locs.append(loc)
+
+        keys = tuple(mem)
+        o = self.keyindex.get(keys)
+        if o is None:
+            o = self.keyindex[keys] = len(self.keys)
+            self.keys.append((keys, frozenset(keys)))
+
+        # Changed values
+        columns = self.columns
+        last = self.last
+        for var, val in mem.items():
+            old = last.get(var, ABSENT)
+            if old is val:
+                continue
+            t = type(val)
+            if t is type(old):
+                if t in self.SCALARS and old == val:
+                    continue
+                if t is float and old == val and val != 0.0:
+                    continue
+            col = columns.get(var)
+            if col is None:
+                col = columns[var] = (array('l'), [])
+                if k > 0:
+                    col[0].append(0)
+                    col[1].append(ABSENT)
+            col[0].append(k)
+            col[1].append(val)
+            last[var] = val
+            self.inmem += 1
+
+        # Variables missing (but present in the previous step)
+        if k > 0 and o != self.order[-1]:
+            cur = self.keys[o][1]
+            for var in self.keys[self.order[-1]][0]:
+                if var not in cur:
+                    col = columns[var]
+                    col[0].append(k)
+                    col[1].append(ABSENT)
+                    last[var] = ABSENT
+                    self.inmem += 1
+
+        self.order.append(o)
+
+        if self.spill is not None and self.inmem > self.spill:
+            self.spillcolumns()
+
+    def spillcolumns(self):
+        '''
+        Moves all values in columns to the spill file (as a single block)
+        '''
+
+        if self.spillfile is None:
+            self.spillfile = SpillFile()
+
+        parts = []
+        data = []
+        size = 0
+        for var, (steps, values) in self.columns.items():
+            if not steps:
+                continue
+            d = SpilledSegment.encode(steps, values, self.kept)
+            parts.append((var, size, len(steps)))
+            data.append(d)
+            size += len(d)
+
+        block = self.spillfile.write(b''.join(data))
+        for var, offset, n in parts:
+            seg = SpilledSegment(block, offset, n, self.kept)
+            self.spilled.setdefault(var, []).append(seg)
+            steps, values = self.columns[var]
+            del steps[:]
+            del values[:]
+
+        self.inmem = 0
+
+    def value(self, var, k, default=None):
+        '''
+        Value of var at step k
+        '''
+
+        col = self.columns.get(var)
+        if col is None:
+            return default
+        steps, values = col
+        if steps and steps[0] <= k:
+            val = values[bisect_right(steps, k) - 1]
+        else:
+            segs = self.spilled[var]
+            lo, hi = 0, len(segs)
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                if segs[mid].steps[0] <= k:
+                    lo = mid
+                else:
+                    hi = mid
+            seg = segs[lo]
+            val = seg[bisect_right(seg.steps, k) - 1]
+        return default if val is ABSENT else val
+
+    def column(self, var):
+        '''
+        Steps at which value of var changed, and those values
+        '''
+
+        if var not in self.spilled:
+            return self.columns.get(var, ((), ()))
+
+        segs = self.spilled[var]
+        steps, values = self.columns[var]
+        return (ChainSeq([seg.steps for seg in segs] + [steps]),
+                ChainSeq(segs + [values]))
+
+    def runs(self):
+        '''
+        Maximal runs of steps in the same function: maps function name to a
+        list of (first step, last step + 1)
+        '''
+
+        runs = {}
+        n = len(self.fncs)
+        start = 0
+        for k in range(1, n + 1):
+            if k == n or self.fncs[k] != self.fncs[start]:
+                fnc = self.fncnames[self.fncs[start]]
+                runs.setdefault(fnc, []).append((start, k))
+                start = k
+        return runs
+
+    def mems(self):
+        '''
+        Memories of all steps (as new dicts), built by applying the changes
+        in order
+        '''
+
+        n = len(self.locs)
+        changes = [[] for _ in range(n)]
+        for var in self.columns:
+            steps, values = self.column(var)
+            for k, val in zip(steps, values):
+                changes[k].append((var, val))
+
+        cur = {}
+        for k in range(n):
+            for var, val in changes[k]:
+                cur[var] = val
+            yield {var: cur[var] for var in self.keys[self.order[k]][0]}
+
+    def __len__(self):
+        return len(self.locs)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [self[i] for i in range(*k.indices(len(self)))]
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError('trace index out of range')
+        return (self.fncnames[self.fncs[k]], self.locs[k], TraceMem(self, k))
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self[k]
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class TraceMem(object):
+    '''
+    Memory at a step of a Trace
+    '''
+
+    __slots__ = ('trace', 'step')
+
+    def __init__(self, trace, step):
+        self.trace = trace
+        self.step = step
+
+    def get(self, var, default=None):
+        return self.trace.value(var, self.step, default)
+
+    def __getitem__(self, var):
+        val = self.trace.value(var, self.step, ABSENT)
+        if val is ABSENT:
+            raise KeyError(var)
+        return val
+
+    def __contains__(self, var):
+        return var in self.trace.keys[self.trace.order[self.step]][1]
+
+    def keys(self):
+        return self.trace.keys[self.trace.order[self.step]][0]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(var, self[var]) for var in self.keys()]
+
+    def values(self):
+        return [self[var] for var in self.keys()]
+
+    def todict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, TraceMem):
+            other = other.todict()
+        if isinstance(other, dict):
+            return self.todict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.todict())
+
+
+def memokey(val):
+    '''
+    Hashable key of a value (of an argument), distinguishing values that are
+    equal, but of different types (e.g., 1 and 1.0); raises TypeError if val
+    cannot be a key
+    '''
+
+    if isinstance(val, (list, tuple)):
+        return (type(val), tuple(memokey(x) for x in val))
+    if isinstance(val, float):
+        return (float, repr(val))
+    hash(val)
+    return (type(val), val)
+
+
 class Interpreter(object):
     DEFAULT_RETURN = UndefValue()
 
-    def __init__(self, timeout=2000, entryfnc='main'):
+    # Wall-clock timeout is checked only every (this+1) steps
+    TIMEOUT_CHECK_MASK = 1023
+
+    # Cache of decoded constants is cleared once it has this many of them
+    # (so that it doesn't grow with every program a long-running process
+    # executes)
+    CONSTS_LIMIT = 10000
+
+    # Operations that use input or output (other than through $in and $out)
+    IMPURE_OPS = set()
+
+    def __init__(self, timeout=2000, entryfnc='main', budget=None,
+                 memo=False):
         self.timeout = timeout
         self.starttime = None
         self.entryfnc = entryfnc
 
+        self.budget = budget or Budget()
+        self.resetbudget()
+
         self.fnc = None
         self.loc = None
+        self.frame = None
+
+        # Memoization of calls of pure functions (see execute_FuncCall)
+        self.memo = memo
+        self.pure = set()
+        self.memotable = {}
+        self.steplog = []  # Steps of calls being memoized
+        self.logging = 0  # Number of such calls
 
-        self.trace = []
+        self.trace = Trace(spill=self.budget.spill)
 
         self.prog = None
 
+        # Decoded constants are shared by all interpreters of the same class
+        cls = self.__class__
+        if '_consts' not in cls.__dict__:
+            cls._consts = {}
+        self.consts = cls._consts
+
+        # So are converters of values to types (see getconverter)
+        if '_converters' not in cls.__dict__:
+            cls._converters = {}
+        self.converters = cls._converters
+
     def getfnc(self, name):
 
         return self.prog.getfnc(name)
@@ -68,14 +660,14 @@ class Interpreter(object):
             mem = dict()
 
         # Init trace
-        self.trace = []
+        self.trace = Trace(spill=self.budget.spill)
 
         # Set inputs
         if ins:
-            mem[VAR_IN] = list(ins)
+            mem[VAR_IN] = InputStream(ins)
         # Set output
         if VAR_OUT not in mem:
-            mem[VAR_OUT] = ''
+            mem[VAR_OUT] = OutputBuffer()
         # Set var
         mem[VAR_RET] = UndefValue()
 
@@ -93,19 +685,48 @@ class Interpreter(object):
             for (var, t), a in zip(fnc.params, args):
                 mem[var] = self.convert(a, t)
 
-        self.starttime = time.time()
+        self.resetbudget()
+
+        # Memo table is only valid for a single run
+        if self.memo:
+            self.pure = self.purefncs(prog)
+            self.memotable = {}
+            self.steplog = []
+            self.logging = 0
 
         res = self.execute(fnc, mem)
+        res.used = Budget(self.steps, self.iters, self.evals, self.depth)
         self.prog = None
         return res
 
-    def execute(self, obj, mem):
+    def evaluate(self, expr, mem):
+        '''
+        Evaluates a single expression (outside of a run) with fresh budget
+        '''
 
-        # Check for timeout
-        # if self.timeout and self.starttime \
-        #         and (time.time() - self.starttime > self.timeout):
-        #     raise RuntimeErr(
-        #         'Timeout (%.3f)' % (round(time.time() - self.starttime, 3),))
+        self.resetbudget()
+
+        return self.execute(expr, mem)
+
+    def resetbudget(self):
+        '''
+        Starts counting (and timing) from zero
+        '''
+
+        inf = float('inf')
+        self.maxsteps = inf if self.budget.steps is None else self.budget.steps
+        self.maxiters = inf if self.budget.iters is None else self.budget.iters
+        self.maxevals = inf if self.budget.evals is None else self.budget.evals
+        self.maxdepth = inf if self.budget.depth is None else self.budget.depth
+
+        self.steps = 0
+        self.iters = 0
+        self.evals = 0
+        self.depth = 0  # Maximal depth of calls (frames on the stack)
+
+        self.starttime = time.time()
+
+    def execute(self, obj, mem):
 
         # Get name of the object to be executed
         name = obj.__class__.__name__
@@ -117,38 +738,211 @@ class Interpreter(object):
                 KeyError) as ex:
             raise RuntimeErr("Exception '%s' on execution of '%s'" % (ex, obj))
 
+    def decode_const(self, value):
+        '''
+        Decodes the (string) value of a constant into a Python value
+        '''
+
+        raise NotImplementedError
+
+    def makeconverter(self, t):
+        '''
+        Function converting values to type t, or None if values of type t are
+        kept as they are; it is shared by all interpreters of the class, so it
+        shouldn't depend on this one
+        '''
+
+        return None
+
+    def getconverter(self, t):
+        '''
+        Converter to type t (see makeconverter), made once per type
+        '''
+
+        try:
+            return self.converters[t]
+        except KeyError:
+            conv = self.converters[t] = self.makeconverter(t)
+            return conv
+
+    def convert(self, val, t):
+        conv = self.getconverter(t)
+        return val if conv is None else conv(val)
+
+    def locprogram(self, fnc, cfg):
+        '''
+        Expressions of each location (by index) of cfg (of fnc) compiled for
+        this interpreter class: tuples of (var, primed var, expr, converter
+        of the value to the type of var); kept in cfg
+        '''
+
+        cls = self.__class__
+        prog = cfg.compiled.get(cls)
+        if prog is None:
+            prog = []
+            for es in cfg.exprs:
+                code = []
+                for var, expr in es:
+                    vtype = (fnc.rettype if var == VAR_RET
+                             else (fnc.gettype(var) or '*'))
+                    code.append((var, prime(var), expr,
+                                 self.getconverter(vtype)))
+                prog.append(tuple(code))
+            prog = cfg.compiled[cls] = tuple(prog)
+        return prog
+
+    def execute_Const(self, c, mem):
+        try:
+            return self.consts[c.value]
+        except KeyError:
+            if len(self.consts) >= self.CONSTS_LIMIT:
+                self.consts.clear()
+            val = self.consts[c.value] = self.decode_const(c.value)
+            return val
+
+    def addstep(self):
+        '''
+        Counts a visited location (checks the budget and timeout)
+        '''
+
+        # Check budget (wall-clock only once in a while, since it's costly)
+        self.steps += 1
+        if self.steps > self.maxsteps:
+            raise BudgetExceeded(
+                'Step limit (%d) exceeded' % (self.maxsteps,))
+        if (self.timeout and not (self.steps & self.TIMEOUT_CHECK_MASK)
+                and time.time() - self.starttime > self.timeout):
+            raise RuntimeErr(
+                'Timeout (%.3f)' % (round(time.time() - self.starttime, 3),))
+
     def execute_Function(self, fnc, mem):
-        self.fnc = fnc.name
-        self.loc = fnc.initloc
-        eof_visited = False
-        while True:
-            for (var, expr) in fnc.exprs(self.loc):
-                val = self.execute(expr, mem)
-                if var == VAR_COND:
-                    if val == [EOF]:
-                        val = False
-                    elif isinstance(val, list) and len(val) == 0:
-                        val = True
-                    else:
-                        val = not not val
-                varp = prime(var)
-                vtype = (fnc.rettype if var == VAR_RET else (fnc.gettype(var) or '*'))
-                mem[varp] = self.convert(val, vtype)
-                if var == VAR_RET and not isundef(val):
-                    break
-            (newmem, mem) = self.procmem(mem)
-            self.trace.append((self.fnc, self.loc, mem))
-            mem = newmem
-            if not isundef(mem.get(VAR_RET, UndefValue())):
-                break
-            numtrans = fnc.numtrans(self.loc)
-            if numtrans == 0:  # Done
-                break
-            elif numtrans == 1:  # Trivially choose True
-                self.loc = fnc.trans(self.loc, True)
-            else:
-                self.loc = fnc.trans(self.loc, mem.get(VAR_COND))
-        return self.trace
+        '''
+        Executes fnc, together with the functions it calls, which are kept
+        on an explicit stack of frames (instead of recursion): a call raises
+        CallRequest from the caller's expression, and once the callee
+        returns, that expression is evaluated again, with the results of
+        calls made so far taken from its frame (see execute_FuncCall)
+        '''
+
+        oldframe = self.frame
+        frame = Frame(fnc, mem)
+        stack = [frame]
+        if self.depth < 1:
+            self.depth = 1
+        self.addstep()
+
+        try:
+            while True:
+                fnc = frame.fnc
+                mem = frame.mem
+                cfg = frame.cfg
+                locs, succ, arity, back = (
+                    cfg.locs, cfg.succ, cfg.arity, cfg.back)
+                exprs = self.locprogram(fnc, cfg)
+                i = frame.i
+                self.fnc = fnc.name
+                self.loc = locs[i]
+                self.frame = frame
+
+                try:
+                    while True:
+                        es = exprs[i]
+                        j = frame.j
+                        while j < len(es):
+                            var, varp, expr, conv = es[j]
+                            if frame.results:
+                                # Evaluated again, so undo its effects
+                                for v, val in zip((VAR_IN, VAR_OUT),
+                                                  frame.saved):
+                                    if val is ABSENT:
+                                        mem.pop(v, None)
+                                    else:
+                                        mem[v] = val
+                            else:
+                                self.evals += 1
+                                if self.evals > self.maxevals:
+                                    raise BudgetExceeded(
+                                        'Evaluation limit (%d) exceeded' % (
+                                            self.maxevals,))
+                                frame.saved = (mem.get(VAR_IN, ABSENT),
+                                               mem.get(VAR_OUT, ABSENT))
+                            frame.ncalls = 0
+                            val = self.execute(expr, mem)
+                            if frame.results:
+                                frame.results = {}
+                            j += 1
+                            if var == VAR_COND:
+                                if val == [EOF]:
+                                    val = False
+                                elif (isinstance(val, (list, InputStream))
+                                      and len(val) == 0):
+                                    val = True
+                                else:
+                                    val = not not val
+                            if conv is not None:
+                                val = conv(val)
+                            mem[varp] = val
+                            if var == VAR_RET and not isundef(val):
+                                break
+                        frame.j = 0
+                        (newmem, mem) = self.procmem(mem)
+                        self.trace.append((self.fnc, self.loc, mem))
+                        if self.logging:
+                            self.steplog.append((self.fnc, self.loc, mem))
+                        last = mem
+                        mem = frame.mem = newmem
+                        if not isundef(mem.get(VAR_RET, UndefValue())):
+                            break
+                        n = arity[i]
+                        if n == 0:  # Done
+                            break
+                        # Trivially choose True, or choose by condition
+                        cond = True if n == 1 else mem.get(VAR_COND)
+                        if back[i][cond]:
+                            self.iters += 1
+                            if self.iters > self.maxiters:
+                                raise BudgetExceeded(
+                                    'Loop iteration limit (%d) exceeded' % (
+                                        self.maxiters,))
+                        i = frame.i = succ[i][cond]
+                        self.loc = locs[i]
+                        self.addstep()
+
+                except CallRequest as req:
+                    # Call (from the j-th expression of the frame)
+                    frame.j = j
+                    if len(stack) >= self.maxdepth:
+                        raise BudgetExceeded(
+                            'Call depth limit (%d) exceeded' % (
+                                self.maxdepth,))
+                    frame = Frame(req.fnc, req.mem)
+                    if req.memokey is not None:
+                        frame.memokey = req.memokey
+                        frame.start = (len(self.steplog), self.steps,
+                                       self.evals, self.iters)
+                        self.logging += 1
+                    stack.append(frame)
+                    frame.depth = len(stack)
+                    if frame.depth > self.depth:
+                        self.depth = frame.depth
+                    self.addstep()
+                    continue
+
+                # Return (to the caller, if any)
+                stack.pop()
+                res = last.get(prime(VAR_RET), self.DEFAULT_RETURN)
+                if frame.memokey is not None:
+                    self.memorize(frame, res)
+                if not stack:
+                    return self.trace
+                callee = frame
+                frame = stack[-1]
+                frame.height = max(frame.height, callee.height + 1)
+                n, end = frame.pending
+                frame.results[n] = (res, end)
+
+        finally:
+            self.frame = oldframe
 
     def procmem(self, mem):
         newmem = dict()
@@ -196,6 +990,10 @@ class Interpreter(object):
         t = l.args[0].value
         l = self.execute(l.args[1], mem)
 
+        if isinstance(l, InputStream):
+            h = l.head()
+            return EOF if h == EOF else self.convert(h, t)
+
         if isinstance(l, list):
             if len(l) == 0 or l == [EOF]:
                 return EOF
@@ -207,6 +1005,9 @@ class Interpreter(object):
     def execute_ListTail(self, l, mem):
         l = self.execute(l.args[0], mem)
 
+        if isinstance(l, InputStream):
+            return l.tail()
+
         if isinstance(l, list):
             if l == [EOF] or len(l) == 0:
                 return [EOF]
@@ -216,7 +1017,10 @@ class Interpreter(object):
         raise RuntimeErr("ListTail on '%s'" % (l,))
 
     def execute_StrAppend(self, a, mem):
-        return ''.join([str(self.execute(x, mem)) for x in a.args])
+        vals = [self.execute(x, mem) for x in a.args]
+        if vals and isinstance(vals[0], OutputBuffer):
+            return vals[0].append(''.join([str(x) for x in vals[1:]]))
+        return ''.join([str(x) for x in vals])
 
     def execute_StrFormat(self, f, mem):
 
@@ -244,6 +1048,18 @@ class Interpreter(object):
         except KeyError:
             raise RuntimeErr("Unknown function: '%s'" % (name,))
 
+        # Result of this call is known when the calling expression is
+        # evaluated again (after the call returned), then also its arguments
+        # (with calls in them) are skipped
+        frame = self.frame
+        if frame is not None:
+            n = frame.ncalls
+            frame.ncalls += 1
+            res = frame.results.get(n)
+            if res is not None:
+                frame.ncalls = res[1]
+                return res[0]
+
         args = [self.execute(x, mem) for x in f.args[1:]]
 
         newmem = {
@@ -258,13 +1074,174 @@ class Interpreter(object):
         for (var, _), arg in zip(fnc.params, args):
             newmem[var] = deepcopy(arg)
 
-        oldfnc = self.fnc
-        oldloc = self.loc
-        trace = self.execute(fnc, newmem)
-        self.fnc = oldfnc
-        self.loc = oldloc
+        # Outside of a run (e.g., evaluate), so execute it right away
+        if frame is None:
+            oldfnc = self.fnc
+            oldloc = self.loc
+            trace = self.execute(fnc, newmem)
+            self.fnc = oldfnc
+            self.loc = oldloc
+
+            return trace[-1][2].get(prime(VAR_RET), self.DEFAULT_RETURN)
+
+        frame.pending = (n, frame.ncalls)
+
+        # Call of a pure function with the same arguments as before
+        key = self.getmemokey(fnc, args)
+        entry = self.memotable.get(key) if key is not None else None
+        if entry is not None and self.recall(entry, newmem, frame.depth + 1):
+            res = deepcopy(entry[0])
+            frame.results[n] = (res, frame.ncalls)
+            return res
+
+        raise CallRequest(fnc, newmem, key)
+
+    def purefncs(self, prog):
+        '''
+        Names of functions of prog that don't use input and output, not even
+        through functions they call
+        '''
+
+        pure = set()
+        calls = {}
+        for fnc in prog.getfncs():
+            calls[fnc.name] = set()
+            ok = True
+            for loc in fnc.locs():
+                for var, expr in fnc.exprs(loc):
+                    if var in (VAR_IN, VAR_OUT):
+                        ok = False
+                    todo = [expr]
+                    while todo:
+                        e = todo.pop()
+                        if isinstance(e, Var):
+                            if e.name in (VAR_IN, VAR_OUT):
+                                ok = False
+                        elif isinstance(e, Op):
+                            if e.name in self.IMPURE_OPS:
+                                ok = False
+                            if e.name == 'FuncCall':
+                                calls[fnc.name].add(e.args[0].name)
+                                todo.extend(e.args[1:])
+                            else:
+                                todo.extend(e.args)
+            if ok:
+                pure.add(fnc.name)
+
+        # Remove functions calling (possibly) impure ones
+        changed = True
+        while changed:
+            changed = False
+            for name in list(pure):
+                if not calls[name] <= pure:
+                    pure.discard(name)
+                    changed = True
+
+        return pure
+
+    def getmemokey(self, fnc, args):
+        '''
+        Key of a call in the memo table (None if it shouldn't be memoized)
+        '''
+
+        if not self.memo or fnc.name not in self.pure:
+            return None
+        try:
+            return (fnc.name, memokey(args))
+        except TypeError:  # Unhashable argument
+            return None
+
+    def memorize(self, frame, res):
+        '''
+        Remembers the result of a returned (memoized) call, together with its
+        steps (including nested calls) and used budget
+        '''
+
+        start, steps, evals, iters = frame.start
+        self.memotable[frame.memokey] = (
+            deepcopy(res), self.steplog[start:], self.steps - steps,
+            self.evals - evals, self.iters - iters, frame.height)
+        self.logging -= 1
+        if not self.logging:
+            self.steplog = []
+
+    def recall(self, entry, mem, depth):
+        '''
+        Repeats a memoized call (from memory mem of the callee, at the given
+        depth): adds its steps to the trace (with the current input and
+        output, which the pure function didn't use) and its used budget;
+        returns False if that would exceed the budget (so that the call is
+        executed, and fails, as without memoization)
+        '''
+
+        _, steps, nsteps, nevals, niters, height = entry
+
+        if (self.steps + nsteps > self.maxsteps
+                or self.evals + nevals > self.maxevals
+                or self.iters + niters > self.maxiters
+                or depth + height > self.maxdepth):
+            return False
+        self.steps += nsteps
+        self.evals += nevals
+        self.iters += niters
+        self.depth = max(self.depth, depth + height)
+        self.frame.height = max(self.frame.height, height + 1)
+
+        io = {}
+        for var in (VAR_IN, VAR_OUT):
+            io[var] = io[prime(var)] = mem[var]
+        for (fnc, loc, m) in steps:
+            m = dict(m)
+            for var in io:
+                if var in m:
+                    m[var] = io[var]
+            self.trace.append((fnc, loc, m))
+            if self.logging:
+                self.steplog.append((fnc, loc, m))
+
+        return True
+
+
+def runinputs(I, prog, inputs):
+    '''
+    Runs prog by interpreter I on each of inputs (pairs of ins and args);
+    returns (trace, None) for each execution that succeeded and (None, error)
+    for each that failed
+    '''
+
+    res = []
+    for ins, args in inputs:
+        try:
+            res.append((I.run(prog, ins=ins, args=args), None))
+        except RuntimeErr as ex:
+            res.append((None, ex))
+    return res
+
+
+def runtask(task):
+    '''
+    Runs a task of runmany, a single input (in a worker of a pool)
+    '''
+
+    inter, opts, prog, ins, args = task
+    return runinputs(inter(**opts), prog, [(ins, args)])[0]
+
+
+def runmany(inter, prog, ins, args, pool=None, **opts):
+    '''
+    Runs prog on each of the inputs (ins and args) by an interpreter of class
+    inter (created with opts); returns a list of (trace, error) in the order
+    of the inputs, where error (RuntimeErr) is None for executions that
+    succeeded, so a failure on one of the inputs doesn't stop the others.
+    With a pool (multiprocessing.Pool, or ThreadPool, since every task has
+    its own interpreter) the inputs are run concurrently.
+    '''
+
+    if pool is None or len(ins) < 2:
+        return runinputs(inter(**opts), prog, list(zip(ins, args)))
 
-        return trace[-1][2].get(prime(VAR_RET), self.DEFAULT_RETURN)
+    return pool.map(runtask, [(inter, opts, prog, i, a)
+                              for i, a in zip(ins, args)])
 
 
 INTERPRETERS = {}
@@ -4,17 +4,23 @@ Simulation relation
 
 # clara.py imports
 from .common import debug, equals
-from .interpreter import Interpreter, RuntimeErr, UndefValue, isundef
-from .model import SPECIAL_VARS, VAR_RET, VAR_IN, VAR_OUT, isprimed, prime
+from .interpreter import Interpreter, RuntimeErr, Trace, UndefValue, isundef
+from .interpreter import ABSENT, runmany
+from .model import SPECIAL_VARS, VAR_RET, VAR_IN, VAR_OUT, VarIndex, isprimed, prime
 
 
 class Matching(object):
 
-    def __init__(self, ignoreio=False, ignoreret=False, verbose=False, debugvar=None, bijective=True):
+    def __init__(self, ignoreio=False, ignoreret=False, verbose=False, debugvar=None, bijective=True,
+                 budget=None, memo=False, pool=None):
 
         self.ignoreio = ignoreio
         self.ignoreret = ignoreret
 
+        self.budget = budget  # Budget of executions (None for default)
+        self.memo = memo  # Memoize calls of pure functions in executions
+        self.pool = pool  # Pool running executions on inputs (None: serially)
+
         self.bijective = bijective
 
         self.verbose = verbose
@@ -25,17 +31,72 @@ class Matching(object):
             return
         debug(*args)
 
-    def match_mems(self, match, loc, mem1, mem2, V1, V2):
+    def one_to_one(self, match, index, taken=0):
+
+        if len(match) == 0:
+            return {}
+
+        var1, matches = match[0]
+
+        for var2, bit in index.items(matches & ~taken):
+            m = self.one_to_one(match[1:], index, taken | bit)
+            if m is not None:
+                m = dict(m)
+                m[var1] = var2
+                return m
 
-        # V2 = ({var2 for var2 in mem2.keys() if not isprimed(var2)}
-        #      - SPECIAL_VARS)
+    def match_columns(self, t1, var1, t2, var2, runs):
+        '''
+        Checks that the values of var1 (in t1) and var2 (in t2) are equal
+        (or the first is undefined) at all steps of runs, comparing them only
+        once per segment of steps where neither of them changed; returns the
+        first step where they are not equal (None if they are)
+        '''
+
+        s1, v1 = t1.column(var1)
+        s2, v2 = t2.column(var2)
+        n1 = len(s1)
+        n2 = len(s2)
+        i = j = -1  # Current value (of each column) is at this index
+
+        for start, end in runs:
+            k = start
+            while k < end:
+                while i + 1 < n1 and s1[i + 1] <= k:
+                    i += 1
+                while j + 1 < n2 and s2[j + 1] <= k:
+                    j += 1
+
+                val1 = v1[i] if i >= 0 else ABSENT
+                val2 = v2[j] if j >= 0 else ABSENT
+                if val1 is ABSENT:
+                    val1 = UndefValue()
+                if val2 is ABSENT:
+                    val2 = UndefValue()
+                if not (isundef(val1) or equals(val1, val2)):
+                    return k
+
+                # Next change of either column (within this run)
+                k = end
+                if i + 1 < n1 and s1[i + 1] < k:
+                    k = s1[i + 1]
+                if j + 1 < n2 and s2[j + 1] < k:
+                    k = s2[j + 1]
+
+    def match_columns_fnc(self, match, fnc, t1, t2, runs, V1, V2, index):
+        '''
+        Narrows down potential matches of variables of fnc by comparing
+        their columns at all steps (runs) of fnc in a pair of traces at once;
+        sets of variables are bitmasks (w.r.t. index of V2 and special vars),
+        so match maps var1 to a bitmask of its potential matches. Returns
+        False if some variable has no potential match left.
+        '''
 
         if self.bijective:
-            if len(V1 | SPECIAL_VARS) != len(V2 | SPECIAL_VARS):
+            if len(V1 | SPECIAL_VARS) != len(index):
                 self.debug('Not bijective - different number of variables')
                 return False
 
-        # Go through all variables
         for var1 in V1 | SPECIAL_VARS:
 
             # Ignored vars
@@ -47,15 +108,14 @@ class Matching(object):
             # If var1 not matched yet, build a list of potential matches
             if var1 not in match:
                 if var1 in SPECIAL_VARS:
-                    match[var1] = set([var1])
+                    match[var1] = index.bit(var1)
                 else:
-                    match[var1] = set(V2)
+                    match[var1] = index.tobits(V2)
 
             # Check list of potential matches
-            newmatch = set([])
+            newmatch = 0
             varp1 = prime(var1)
-            for var2 in match[var1]:
-                varp2 = prime(var2)
+            for var2, bit in index.items(match[var1]):
 
                 if var1.startswith('ind#') != var2.startswith('ind#'):
                     continue
@@ -63,27 +123,18 @@ class Matching(object):
                 if var1.startswith('iter#') != var2.startswith('iter#'):
                     continue
 
-                # Get values
-                val1 = mem1.get(varp1, UndefValue())
-                val2 = mem2.get(varp2, UndefValue())
-
-                # Debug vars
-                if self.debugvar == '%s-%s' % (loc, var1):
-                    self.debug('VAR %s = %s', var1, val1)
-                    self.debug('VAR %s = %s', var2, val2)
-                    if isundef(val1) or equals(val1, val2):
-                        self.debug('VAR equal')
-                    else:
-                        self.debug('VAR unequal')
+                k = self.match_columns(t1, varp1, t2, prime(var2), runs)
+                if k is None:
+                    newmatch |= bit
+                elif self.debugvar == '%s-%s-%s' % (fnc, t1.locs[k], var1):
+                    self.debug('VAR %s = %s', var1, t1.value(varp1, k))
+                    self.debug('VAR %s = %s', var2, t2.value(prime(var2), k))
+                    self.debug('VAR unequal')
                     self.debug('')
 
-                # Check if equal
-                if isundef(val1) or equals(val1, val2):
-                    newmatch.add(var2)
-
             # If no match for then done
-            if len(newmatch) == 0:
-                self.debug("Couldn find match for %s-%s", loc, var1)
+            if newmatch == 0:
+                self.debug("Couldn find match for %s-%s", fnc, var1)
                 return False
             # Otherwise replace with new matches
             else:
@@ -91,29 +142,6 @@ class Matching(object):
 
         return True
 
-    def one_to_one(self, match, taken=None):
-
-        if len(match) == 0:
-            return {}
-
-        if taken is None:
-            taken = set()
-
-        var1, matches = match[0]
-
-        for var2 in matches:
-            if var2 in taken:
-                continue
-
-            newtaken = set(taken)
-            newtaken.add(var2)
-
-            m = self.one_to_one(match[1:], newtaken)
-            if m is not None:
-                m = dict(m)
-                m[var1] = var2
-                return m
-
     def match_traces(self, T1, T2, sm, V1, V2):
 
         # Check number of traces
@@ -122,39 +150,51 @@ class Matching(object):
                        len(T1), len(T2))
             return
 
+        # Index of variables of each function (of the second program)
+        index = {fnc: VarIndex(V2[fnc] | SPECIAL_VARS) for fnc in V2}
+
         # Go through each trace
         match = {}
         for t1, t2 in zip(T1, T2):
+            if not isinstance(t1, Trace):
+                t1 = Trace(t1)
+            if not isinstance(t2, Trace):
+                t2 = Trace(t2)
 
             # Check length of traces
             if len(t1) != len(t2):
                 self.debug('Different length of traces (%d <> %d)', len(t1), len(t2))
                 return
 
-            for (fnc1, loc1, mem1), (fnc2, loc2, mem2) in zip(t1, t2):
-
-                # Check if valid with struct match
-                if fnc1 != fnc2:
+            # Check if valid with struct match
+            names1 = t1.fncnames
+            names2 = t2.fncnames
+            for f1, loc1, f2, loc2 in zip(t1.fncs, t1.locs, t2.fncs, t2.locs):
+                fnc1 = names1[f1]
+                if fnc1 != names2[f2]:
                     return
                 if sm[fnc1][loc1] != loc2:
                     return
 
-                # Check memories
-                if fnc1 not in match:
-                    match[fnc1] = {}
-                if not self.match_mems(match[fnc1], '%s-%s' % (fnc1, loc1),
-                                       mem1, mem2, V1[fnc1], V2[fnc2]):
+            # Check memories (by columns of variables)
+            for fnc, runs in t1.runs().items():
+                if fnc not in match:
+                    match[fnc] = {}
+                if not self.match_columns_fnc(match[fnc], fnc, t1, t2, runs,
+                                              V1[fnc], V2[fnc], index[fnc]):
                     return
 
         # Debug matches
         for fnc in match:
             for var, m in list(match[fnc].items()):
-                self.debug('matches for %s-%s: %s' % (fnc, var, m))
+                self.debug('matches for %s-%s: %s' % (
+                    fnc, var, index[fnc].tovars(m)))
 
         # Construct one-to-one match
         newmatch = {}
         for fnc in sm:
-            newmatch[fnc] = self.one_to_one(list(match.get(fnc, {}).items()))
+            newmatch[fnc] = self.one_to_one(
+                list(match.get(fnc, {}).items()), index.get(fnc))
             if newmatch[fnc] is None:
                 self.debug("Couldn't find one-to-one match for '%s'", fnc)
                 return
@@ -174,55 +214,55 @@ class Matching(object):
                 return
 
         for fnc1 in fncs1:
-
             if fnc1 not in fncs2:
                 self.debug("Function '%s' not found in Q", fnc1)
                 return
 
-            f1 = P.getfnc(fnc1)
-            f2 = Q.getfnc(fnc1)
+        # Different canonical structure cannot match (hashes are remembered
+        # by programs, so this is cheap)
+        if P.structhash() != Q.structhash():
+            self.debug("Different structure hash")
+            return
+
+        for fnc1 in fncs1:
 
-            # Compare structure of two functions
-            def build_sm(loc1, loc2):
+            c1 = P.getfnc(fnc1).cfg()
+            c2 = Q.getfnc(fnc1).cfg()
+
+            # Compare structure of two functions (on indices of locations),
+            # rev is the reverse of smi
+            smi, rev = {}, {}
+            todo = [(c1.init, c2.init)]
+            while todo:
+                i1, i2 = todo.pop()
 
                 # Check if already mapped
-                if loc1 in sm[fnc1]:
-                    return sm[fnc1][loc1] == loc2
+                if i1 in smi:
+                    if smi[i1] != i2:
+                        return
+                    continue
 
-                # Check if loc2 already mapped
-                if loc2 in list(sm[fnc1].values()):
-                    return False
+                # Check if i2 already mapped
+                if i2 in rev:
+                    return
 
                 # Remember this pair
-                sm[fnc1][loc1] = loc2
+                smi[i1] = i2
+                rev[i2] = i1
 
                 # Check number of transitions
-                n1 = f1.numtrans(loc1)
-                n2 = f2.numtrans(loc2)
+                n1 = c1.arity[i1]
+                n2 = c2.arity[i2]
                 if n1 != n2:
-                    return False
-
-                # Done
-                if n1 == 0:
-                    return True
-
-                # Check True
-                nloc1 = f1.trans(loc1, True)
-                nloc2 = f2.trans(loc2, True)
-                if not build_sm(nloc1, nloc2):
-                    return False
-                if n1 == 1:
-                    return True
-
-                # Check False
-                nloc1 = f1.trans(loc1, False)
-                nloc2 = f2.trans(loc2, False)
-                return build_sm(nloc1, nloc2)
-
-            # Start from initial locations
-            sm[fnc1] = {}
-            if not build_sm(f1.initloc, f2.initloc):
-                return
+                    return
+
+                # Check False (if any) after True
+                if n1 == 2:
+                    todo.append((c1.succ[i1][False], c2.succ[i2][False]))
+                if n1 >= 1:
+                    todo.append((c1.succ[i1][True], c2.succ[i2][True]))
+
+            sm[fnc1] = {c1.locs[i1]: c2.locs[i2] for (i1, i2) in smi.items()}
 
         return sm
 
@@ -251,18 +291,22 @@ class Matching(object):
         if not args:
             args = [None for _ in range(len(ins))]
 
-        # Create interpreter
-        I = inter(timeout=timeout, entryfnc=entryfnc)
+        # Run both programs on all inputs and args
+        opts = dict(timeout=timeout, entryfnc=entryfnc, budget=self.budget,
+                    memo=self.memo)
+        R1 = runmany(inter, P, ins, args, pool=self.pool, **opts)
+        R2 = runmany(inter, Q, ins, args, pool=self.pool, **opts)
 
         # Init traces
         T1 = []
         T2 = []
 
-        # Go through inputs and arguments
-        for i, a in zip(ins, args):
-            # Run both programs on each input and arg
-            t1 = I.run(P, ins=i, args=a)
-            t2 = I.run(Q, ins=i, args=a)
+        # Go through inputs and arguments (first failure is reported)
+        for (t1, ex1), (t2, ex2) in zip(R1, R2):
+            if ex1 is not None:
+                raise ex1
+            if ex2 is not None:
+                raise ex2
 
             T1.append(t1)
             # self.debug("P1: %s", t1)
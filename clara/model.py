@@ -1,5 +1,7 @@
 import re
-from functools import reduce
+from collections import deque
+from heapq import heappush, heappop
+from sys import intern
 
 VAR_COND = '$cond'
 VAR_RET = '$ret'
@@ -42,6 +44,10 @@ class Expr(object):
     An expression
     '''
 
+    # Many (millions of) expressions are kept in memory (e.g., in clusters),
+    # so nodes have no per-instance __dict__
+    __slots__ = ('line', 'statement', 'original')
+
     def __init__(self, line=None, statement=False, original=None):
         self.line = line
         self.statement = statement
@@ -66,8 +72,54 @@ class Expr(object):
         else:
             return s
 
+    def vars(self):
+        '''
+        Variables (primed ones with a prime)
+        '''
+        return self.varsets()[0]
+
+    def prevars(self):
+        '''
+        Unprimed variables (values before the assignment)
+        '''
+        return self.varsets()[1]
+
+    def postvars(self):
+        '''
+        Primed variables, without a prime (values after the assignment)
+        '''
+        return self.varsets()[2]
+
+    def varnames(self):
+        '''
+        All variables without a prime
+        '''
+        return self.varsets()[3]
+
+    def __getstate__(self):
+        # Only attributes that are set (not None) are pickled, and caches
+        # (starting with '_') are recomputed on demand
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                val = getattr(self, name)
+                if val is not None and not name.startswith('_'):
+                    state[name] = val
+        return state
+
+    def __setstate__(self, state):
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                setattr(self, name, state.get(name))
+
+
+# (vars, prevars, postvars, varnames) of an expression without variables
+NOVARS = (frozenset(), frozenset(), frozenset(), frozenset())
+
 
 class Var(Expr):
+    __slots__ = ('name', 'primed', '_vars')
+
     def __init__(self, name, primed=False, *args, **kwargs):
 
         super(Var, self).__init__(*args, **kwargs)
@@ -77,8 +129,9 @@ class Var(Expr):
         assert isinstance(primed, bool), \
             "Variable 'primed' should be bool, got '%s'" % (primed,)
 
-        self.name = str(name)
+        self.name = intern(str(name))
         self.primed = primed
+        self._vars = None
 
     def copy(self):
         return Var(self.name, self.primed, **self.copyargs())
@@ -91,12 +144,7 @@ class Var(Expr):
             return self.copy()
 
     def replace_vars(self, d):
-        if self.name in d:
-            v = self.copy()
-            v.name = d[self.name]
-        else:
-            v = self.copy()
-
+        v = Var(d.get(self.name, self.name), self.primed, **self.copyargs())
         v.replace_original(d)
 
         return v
@@ -104,9 +152,16 @@ class Var(Expr):
     def prime(self, vars):
         if self.name in vars:
             self.primed = True
+            self._vars = None
 
-    def vars(self):
-        return set([str(self)])
+    def varsets(self):
+        if self._vars is None:
+            name = frozenset([self.name])
+            if self.primed:
+                self._vars = (frozenset([str(self)]), frozenset(), name, name)
+            else:
+                self._vars = (name, name, frozenset(), name)
+        return self._vars
 
     def tostr(self):
         if self.primed:
@@ -142,6 +197,8 @@ class Const(Expr):
     Constant
     '''
 
+    __slots__ = ('value',)
+
     def __init__(self, value, *args, **kwargs):
 
         super(Const, self).__init__(*args, **kwargs)
@@ -149,7 +206,7 @@ class Const(Expr):
         assert isinstance(value, str), \
             "Constant value should be string, got '%s'" % (value,)
 
-        self.value = str(value)
+        self.value = intern(str(value))
 
     def copy(self):
         return Const(self.value, **self.copyargs())
@@ -165,8 +222,8 @@ class Const(Expr):
     def prime(self, vars):
         pass
 
-    def vars(self):
-        return set()
+    def varsets(self):
+        return NOVARS
 
     def tostring(self):
         return self.expr_original(repr(self))
@@ -192,6 +249,10 @@ class Op(Expr):
     Operations
     '''
 
+    # Structural hash and variables are computed once (and reset by prime,
+    # which is the only in-place change of the arguments)
+    __slots__ = ('name', 'args', '_hash', '_vars')
+
     def __init__(self, name, *args, **kwargs):
 
         super(Op, self).__init__(**kwargs)
@@ -203,8 +264,10 @@ class Op(Expr):
                 "Operation's argument (#%d) should be Expression, got '%s'" % (
                     i, arg)
 
-        self.name = str(name)
-        self.args = list(args)
+        self.name = intern(str(name))
+        self.args = tuple(args)
+        self._hash = None
+        self._vars = None
 
     def copy(self):
         return Op(self.name,
@@ -226,11 +289,20 @@ class Op(Expr):
     def prime(self, vars):
         for arg in self.args:
             arg.prime(vars)
-
-    def vars(self):
-        args = self.args[1:] if self.name == 'FuncCall' else self.args
-        return reduce(lambda x, y: x | y, [x.vars() for x in args],
-                      set())
+        self._hash = None
+        self._vars = None
+
+    def varsets(self):
+        if self._vars is None:
+            args = self.args[1:] if self.name == 'FuncCall' else self.args
+            sets = [arg.varsets() for arg in args]
+            if not sets:
+                self._vars = NOVARS
+            elif len(sets) == 1:
+                self._vars = sets[0]
+            else:
+                self._vars = tuple(frozenset().union(*x) for x in zip(*sets))
+        return self._vars
 
     def tostring(self):
         s = '%s(%s)' % (self.name, ', '.join(
@@ -243,8 +315,10 @@ class Op(Expr):
     def __eq__(self, other):
         if other is None: return False
         if not isinstance(other, Op): return False
+        if self is other: return True
         if self.name != other.name: return False
         if len(self.args) != len(other.args): return False
+        if hash(self) != hash(other): return False
         for arg1, arg2 in zip(self.args, other.args):
             if arg1 != arg2: return False
         return True
@@ -253,7 +327,96 @@ class Op(Expr):
         return not self == other
 
     def __hash__(self):
-        return hash((self.name, tuple(self.args)))
+        if self._hash is None:
+            self._hash = hash((self.name, self.args))
+        return self._hash
+
+
+class ExprFactory(object):
+    '''
+    Hash-consing of expressions: structurally equal (sub)expressions are
+    represented by a single (shared) object, so equality becomes identity.
+    Line and original of a shared node are those of its first occurrence,
+    and shared nodes must not be changed in place (e.g., by prime).
+    '''
+
+    def __init__(self):
+        self.table = {}
+
+    def __len__(self):
+        return len(self.table)
+
+    def cons(self, key, mk):
+        e = self.table.get(key)
+        if e is None:
+            e = mk()
+            self.table[key] = e
+        return e
+
+    def var(self, name, primed=False, **kwargs):
+        return self.cons((Var, name, primed),
+                         lambda: Var(name, primed, **kwargs))
+
+    def const(self, value, **kwargs):
+        return self.cons((Const, value), lambda: Const(value, **kwargs))
+
+    def op(self, name, *args, **kwargs):
+        '''
+        Args have to be already hash-consed (by this factory)
+        '''
+        return self.cons((Op, name) + tuple(map(id, args)),
+                         lambda: Op(name, *args, **kwargs))
+
+    def make(self, e, memo=None):
+        '''
+        Hash-consed version of (any) expression e
+        '''
+
+        if memo is None:
+            memo = {}
+        if id(e) in memo:
+            return memo[id(e)]
+
+        if isinstance(e, Var):
+            res = self.var(e.name, e.primed, **e.copyargs())
+        elif isinstance(e, Const):
+            res = self.const(e.value, **e.copyargs())
+        else:
+            res = self.op(e.name, *[self.make(x, memo) for x in e.args],
+                          **e.copyargs())
+
+        memo[id(e)] = res
+        return res
+
+    def replace_vars(self, e, d, memo=None):
+        '''
+        Hash-consed version of e.replace_vars(d), subexpressions without
+        replaced variables are reused
+        '''
+
+        if memo is None:
+            memo = {}
+        if id(e) in memo:
+            return memo[id(e)]
+
+        if isinstance(e, Var):
+            res = self.var(d.get(e.name, e.name), e.primed,
+                           **self.originalargs(e, d))
+        elif isinstance(e, Const):
+            res = self.const(e.value, **self.originalargs(e, d))
+        else:
+            res = self.op(e.name,
+                          *[self.replace_vars(x, d, memo) for x in e.args],
+                          **self.originalargs(e, d))
+
+        memo[id(e)] = res
+        return res
+
+    def originalargs(self, e, d):
+        args = e.copyargs()
+        if args['original'] and args['original'][0] in d:
+            args['original'] = (d[args['original'][0]], args['original'][1])
+        return args
 
 
 def expr_to_dict(e):
@@ -298,6 +461,13 @@ class Program(object):
         self.fncs = {}
         self.meta = {}
         self.warns = []
+        self.struct = None  # (versions of functions, structkey, its hash)
+
+    def __getstate__(self):
+        # Hash of structkey is salted per process, so it is recomputed
+        state = dict(self.__dict__)
+        state['struct'] = None
+        return state
 
     def addfnc(self, fnc):
         self.fncs[fnc.name] = fnc
@@ -333,38 +503,37 @@ class Program(object):
     def tostring(self):
         return '\n\n'.join([x.tostring() for x in list(self.fncs.values())])
 
+    def structkey(self):
+        '''
+        Canonical encoding of the structure (control-flow) of the program:
+        tuple of (function name, CFG.canonical()) pairs; two programs match
+        structurally iff their keys are equal. Remembered while functions
+        are not changed.
+        '''
+
+        versions = tuple((name, self.fncs[name].version)
+                         for name in sorted(self.fncs))
+        if self.struct is None or self.struct[0] != versions:
+            key = tuple((name, self.fncs[name].cfg().canonical())
+                        for (name, _) in versions)
+            self.struct = (versions, key, hash(key))
+        return self.struct[1]
+
+    def structhash(self):
+        '''
+        Hash of structkey
+        '''
+
+        self.structkey()
+        return self.struct[2]
+
     def getstruct(self):
 
         s = []
-        for fname in sorted(self.fncs):
+        for fname, canon in self.structkey():
             sf = []
-            fnc = self.getfnc(fname)
-            dl = {}
-            todo = [fnc.initloc]
-            locs = list()
-            while len(todo) > 0:
-                loc, todo = todo[0], todo[1:]
-                if loc in dl:
-                    continue
-                dl[loc] = len(dl) + 1
-                locs.append(loc)
-                if fnc.trans(loc, True) is not None:
-                    todo.append(fnc.trans(loc, True))
-                if fnc.trans(loc, False) is not None:
-                    todo.append(fnc.trans(loc, False))
-
-            for loc in locs:
-                lt = fnc.trans(loc, True)
-                if lt is None:
-                    lt = ''
-                else:
-                    lt = str(dl[lt])
-                lf = fnc.trans(loc, False)
-                if lf is None:
-                    lf = ''
-                else:
-                    lf = str(dl[lf])
-                sf.append('%s:%s,%s' % (dl[loc], lt, lf))
+            for i, (lt, lf) in enumerate(canon, 1):
+                sf.append('%s:%s,%s' % (i, lt or '', lf or ''))
             s.append('%s{%s}' % (fname, ' '.join(sf)))
         return ' '.join(s)
 
@@ -400,10 +569,30 @@ class Function(object):
 
         self.initloc = None  # Initial location
         self.locexprs = {}  # Location -> (VarxExpr)*
+        self.locvars = {}  # Location -> Var -> Expr (first one in locexprs)
         self.loctrans = {}  # Location -> {True,False} -> Location
         self.locdescs = {}  # Location -> Str (description)
         self.types = {}  # Var -> Type
 
+        self.version = 0  # Incremented on every change of locations or types
+        self.flow = None  # DataFlow (with results) for the current version
+        self.vindex = None  # (version, VarIndex) for the current version
+        self.cfgcache = None  # CFG for the current version
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['flow'] = None
+        state['vindex'] = None
+        state['cfgcache'] = None
+        return state
+
+    def changed(self):
+        '''
+        Marks a change of locations (exprs or transitions) or types
+        '''
+
+        self.version += 1
+
     def addloc(self, loc=None, desc=None):
         '''
         Adds a new location to a function.
@@ -428,8 +617,11 @@ class Function(object):
         if self.initloc is None:
             self.initloc = loc
 
+        self.changed()
+
         # Init exprs, trans, descs
         self.locexprs[loc] = []
+        self.locvars[loc] = {}
         self.loctrans[loc] = {True: None, False: None}
         self.locdescs[loc] = desc
 
@@ -465,22 +657,17 @@ class Function(object):
         Returns an expression for var at loc
         '''
 
-        for (var2, expr) in self.locexprs[loc]:
-            if var == var2:
-                return expr
-
-        return Var(var)
+        expr = self.locvars[loc].get(var)
+        if expr is None:
+            return Var(var)
+        return expr
 
     def hasexpr(self, loc, var):
         '''
         Returns True if there is an expression for var at loc
         '''
 
-        for (var2, _) in self.locexprs[loc]:
-            if var == var2:
-                return True
-
-        return False
+        return var in self.locvars[loc]
 
     def numexprs(self, loc):
         '''
@@ -501,6 +688,8 @@ class Function(object):
             "Expected int>0 for num, got: '%s'" % (num,)
 
         self.locexprs[loc] = self.locexprs[loc][:-num]
+        self.reindex(loc)
+        self.changed()
 
     def trans(self, loc, cond):
         '''
@@ -519,11 +708,25 @@ class Function(object):
         assert isinstance(var, str), "Expected 'str', got '%s'" % (var,)
         assert isinstance(expr, Expr), "Expected 'Expr', for '%s'" % (expr,)
 
+        self.changed()
+
         # Add
         if idx is None:
             self.locexprs[loc].append((var, expr))
+            self.locvars[loc].setdefault(var, expr)
         else:
             self.locexprs[loc].insert(idx, (var, expr))
+            self.reindex(loc)
+
+    def reindex(self, loc):
+        '''
+        Rebuilds index of exprs (by var) for a location
+        '''
+
+        index = {}
+        for (var, expr) in self.locexprs[loc]:
+            index.setdefault(var, expr)
+        self.locvars[loc] = index
 
     def addtrans(self, loc1, cond, loc2):
         '''
@@ -541,6 +744,7 @@ class Function(object):
             "Transition '%s' (%s) already exists" % (loc1, cond)
 
         self.loctrans[loc1][cond] = loc2
+        self.changed()
 
     def numtrans(self, loc):
         '''
@@ -551,6 +755,47 @@ class Function(object):
 
         return sum(1 for v in list(self.loctrans[loc].values()) if v is not None)
 
+    def backedges(self):
+        '''
+        Finds back edges, i.e., transitions (loc1, loc2) closing a loop
+        (depth-first search from the initial location)
+        '''
+
+        edges = set()
+        if self.initloc is None:
+            return edges
+
+        visited = set([self.initloc])
+        onstack = set([self.initloc])
+        stack = [(self.initloc, [True, False])]
+        while stack:
+            loc, conds = stack[-1]
+            if not conds:
+                stack.pop()
+                onstack.discard(loc)
+                continue
+
+            nloc = self.loctrans[loc][conds.pop(0)]
+            if nloc is None:
+                continue
+            if nloc in onstack:
+                edges.add((loc, nloc))
+            elif nloc not in visited:
+                visited.add(nloc)
+                onstack.add(nloc)
+                stack.append((nloc, [True, False]))
+
+        return edges
+
+    def cfg(self):
+        '''
+        Frozen CFG of the function (cached while the function is not changed)
+        '''
+
+        if self.cfgcache is None or self.cfgcache.version != self.version:
+            self.cfgcache = CFG(self)
+        return self.cfgcache
+
     def rmtrans(self, loc, cond):
         '''
         Removes transition from loc1 with label cond
@@ -562,6 +807,7 @@ class Function(object):
             "Invalid label (condition): '%s'" % (cond,)
 
         self.loctrans[loc][cond] = None
+        self.changed()
 
     def rmloc(self, loc):
         '''
@@ -571,8 +817,10 @@ class Function(object):
         assert loc in self.locexprs, "Unknown location: '%s'" % (loc,)
 
         self.locexprs.pop(loc)
+        self.locvars.pop(loc)
         self.loctrans.pop(loc)
         self.locdescs.pop(loc)
+        self.changed()
 
     def replaceexprs(self, loc, exprs):
         '''
@@ -582,6 +830,8 @@ class Function(object):
         assert loc in self.locexprs, "Unknown location: '%s'" % (loc,)
 
         self.locexprs[loc] = []
+        self.locvars[loc] = {}
+        self.changed()
 
         for v, e in exprs:
             self.addexpr(loc, v, e)
@@ -598,6 +848,7 @@ class Function(object):
             return
 
         self.types[var] = type
+        self.changed()
 
     def gettype(self, var):
         '''
@@ -633,51 +884,96 @@ class Function(object):
             usedpost[loc] = set([])
 
             for (_, expr) in self.exprs(loc):
-                used = expr.vars()
-                usedpre[loc] |= set([x for x in used if not isprimed(x)])
-                usedpost[loc] |= set(map(unprime,
-                                         [x for x in used if isprimed(x)]))
+                usedpre[loc] |= expr.prevars()
+                usedpost[loc] |= expr.postvars()
 
         return usedpre, usedpost
 
+    def varindex(self):
+        '''
+        VarIndex of all variables appearing in the function (and special
+        variables), cached while the function is not changed
+        '''
+
+        if self.vindex is None or self.vindex[0] != self.version:
+            allvars = set(SPECIAL_VARS) | set(self.types)
+            allvars |= {v for (v, _) in self.params}
+            for loc in self.locs():
+                allvars |= set(self.locvars[loc])
+                for (_, expr) in self.locexprs[loc]:
+                    allvars |= expr.varnames()
+            self.vindex = (self.version, VarIndex(allvars))
+        return self.vindex[1]
+
+    def dataflow(self):
+        '''
+        DataFlow of the function (cached while the function is not changed)
+        '''
+
+        if self.flow is None or self.flow.version != self.version:
+            self.flow = DataFlow(self)
+        return self.flow
+
     def live(self, used=None):
         '''
         Finds "live" variables for each location
-        Algorithm from wikipedia:
-        https://en.wikipedia.org/wiki/Live_variable_analysis
+        (backward may-analysis, see DataFlow)
         '''
 
-        # Initialization
-        if used is None:
-            used = self.used()
-        used = used[0]
+        flow = self.dataflow()
+        index = flow.varindex
+
+        cache = used is None
+        if cache and 'live' in flow.results:
+            livein, liveout = flow.results['live']
+        else:
+            if used is None:
+                used = self.used()
+            used = used[0]
+
+            gen, kill = {}, {}
+            for loc in flow.locs:
+                gen[loc] = index.tobits(used[loc])
+                kill[loc] = index.tobits(self.locvars[loc])
 
-        locs = self.locs()
-        assigned = {loc: {var for (var, _) in self.exprs(loc)} for loc in locs}
-        succ = {loc: {l for l in list(self.loctrans[loc].values()) if l is not None}
-                for loc in locs}
+            # Note: Special vars are always live!
+            livein, liveout = flow.solve(gen, kill, backward=True,
+                                         always=index.tobits(SPECIAL_VARS))
+            if cache:
+                flow.results['live'] = (livein, liveout)
 
-        # Note: Special vars are always live!
-        livein = {loc: set(SPECIAL_VARS) for loc in locs}
-        livein[self.initloc] |= {v for (v, _) in self.params}
-        liveout = {loc: set(SPECIAL_VARS) for loc in locs}
+        return ({loc: index.tovars(b) for (loc, b) in livein.items()},
+                {loc: index.tovars(b) for (loc, b) in liveout.items()})
 
-        changed = True
-        while changed:
-            changed = False
+    def reaching(self):
+        '''
+        Finds definitions, i.e., pairs (loc, var) of assignments, reaching
+        each location (forward may-analysis, see DataFlow)
+        '''
 
-            for loc in locs:
-                n, m = len(livein[loc]), len(liveout[loc])
+        flow = self.dataflow()
 
-                livein[loc] = used[loc] | (liveout[loc] - assigned[loc])
+        if 'reaching' not in flow.results:
+            defs = [(loc, var) for loc in flow.locs for var in self.locvars[loc]]
+            index = {d: i for (i, d) in enumerate(defs)}
 
-                for sloc in succ[loc]:
-                    liveout[loc] |= livein[sloc]
+            vardefs = {}
+            for (loc, var) in defs:
+                vardefs[var] = vardefs.get(var, 0) | (1 << index[(loc, var)])
 
-                if n != len(livein[loc]) or m != len(liveout[loc]):
-                    changed = True
+            gen, kill = {}, {}
+            for loc in flow.locs:
+                gen[loc] = kill[loc] = 0
+                for var in self.locvars[loc]:
+                    gen[loc] |= 1 << index[(loc, var)]
+                    kill[loc] |= vardefs[var]
 
-        return (livein, liveout)
+            reachin, _ = flow.solve(gen, kill)
+            flow.results['reaching'] = {
+                loc: {defs[i] for i in bitindices(b)}
+                for (loc, b) in reachin.items()}
+
+        return {loc: set(r) for (loc, r) in flow.results['reaching'].items()}
 
     def slice(self, merge=False):
         '''
@@ -689,6 +985,9 @@ class Function(object):
         livein, liveout = self.live(used=used)
         usedpre, usedpost = used
 
+        # Variables used after slicing
+        usedvars = {v for (v, _) in self.params}
+
         for loc in self.locs():
 
             exprs = []
@@ -711,17 +1010,13 @@ class Function(object):
                     continue
 
                 exprs.append((var, expr))
+                usedvars |= expr.varnames()
 
             self.replaceexprs(loc, exprs)
 
         # Remove unused variables
-        usedpre, usedpost = self.used()
-        used = set()
-        for loc in self.locs():
-            used |= usedpre[loc] | usedpost[loc]
-        used |= {v for (v, _) in self.params}
         for v in list(self.types):
-            if v not in used:
+            if v not in usedvars:
                 del self.types[v]
 
     def tostring(self):
@@ -769,3 +1064,243 @@ class Function(object):
                 self.loctrans[loc][True], self.loctrans[loc][False]))
 
         return '\n'.join(s)
+
+
+def bitindices(bits):
+    '''
+    Indices of set bits of (non-negative) int bits
+    '''
+
+    i = 0
+    while bits:
+        if bits & 1:
+            yield i
+        bits >>= 1
+        i += 1
+
+
+class VarIndex(object):
+    '''
+    Numbering of variables, for sets of variables encoded as bitmasks (ints)
+    '''
+
+    def __init__(self, vars):
+        self.vars = sorted(vars)
+        self.bits = {v: 1 << i for (i, v) in enumerate(self.vars)}
+        self.all = (1 << len(self.vars)) - 1
+
+    def __len__(self):
+        return len(self.vars)
+
+    def __contains__(self, var):
+        return var in self.bits
+
+    def bit(self, var):
+        return self.bits[var]
+
+    def tobits(self, vars):
+        '''
+        Bitmask of vars
+        '''
+
+        bits = 0
+        for v in vars:
+            bits |= self.bits[v]
+        return bits
+
+    def tovars(self, bits):
+        '''
+        Set of vars of a bitmask
+        '''
+
+        return {self.vars[i] for i in bitindices(bits)}
+
+    def items(self, bits):
+        '''
+        (var, bit) pairs of a bitmask (in the order of numbering)
+        '''
+
+        return [(self.vars[i], 1 << i) for i in bitindices(bits)]
+
+
+def bitcount(bits):
+    '''
+    Number of set bits of (non-negative) int bits
+    '''
+
+    return bin(bits).count('1')
+
+
+class CFG(object):
+    '''
+    Frozen, array-backed control-flow graph of a function; locations are
+    indexed 0..n-1 (in the order of location numbers) and for index i:
+    - locs[i] - location (index[loc] is the other way around)
+    - succ[i] - pair (False, True) of indices of successors (None if there
+      is no transition), so it can be indexed by a condition directly
+    - arity[i] - number of transitions
+    - back[i] - pair (False, True) of flags, whether transitions are back
+      edges (i.e., loop iterations)
+    - exprs[i] - tuple of (var, expr) pairs
+    init is the index of the initial location; compiled keeps forms of the
+    CFG compiled by its users (e.g., interpreters), by their keys
+    '''
+
+    def __init__(self, fnc):
+        self.version = fnc.version
+
+        self.locs = tuple(sorted(fnc.locs()))
+        self.index = {loc: i for (i, loc) in enumerate(self.locs)}
+        self.init = self.index.get(fnc.initloc)
+
+        backedges = fnc.backedges()
+
+        succ, arity, back, exprs = [], [], [], []
+        for loc in self.locs:
+            trans = fnc.loctrans[loc]
+            succ.append(tuple(self.index.get(trans[cond])
+                              for cond in (False, True)))
+            arity.append(sum(1 for cond in (False, True)
+                             if trans[cond] is not None))
+            back.append(tuple((loc, trans[cond]) in backedges
+                              for cond in (False, True)))
+            exprs.append(tuple(fnc.locexprs[loc]))
+
+        self.succ = tuple(succ)
+        self.arity = tuple(arity)
+        self.back = tuple(back)
+        self.exprs = tuple(exprs)
+
+        self.canon = None
+        self.compiled = {}
+
+    def __len__(self):
+        return len(self.locs)
+
+    def canonical(self):
+        '''
+        Canonical encoding of the CFG: locations reachable from the initial
+        one are numbered 1..n in BFS order (True before False), and the
+        result is a tuple of (True, False) pairs of successor numbers (0 if
+        there is no transition)
+        '''
+
+        if self.canon is None:
+            num = {}
+            order = []
+            if self.init is not None:
+                num[self.init] = 1
+                order.append(self.init)
+                todo = deque([self.init])
+                while todo:
+                    i = todo.popleft()
+                    for j in (self.succ[i][True], self.succ[i][False]):
+                        if j is not None and j not in num:
+                            num[j] = len(num) + 1
+                            order.append(j)
+                            todo.append(j)
+
+            self.canon = tuple(
+                (num.get(self.succ[i][True], 0), num.get(self.succ[i][False], 0))
+                for i in order)
+        return self.canon
+
+
+class DataFlow(object):
+    '''
+    Iterative dataflow analysis over locations of a function:
+    - locations are taken from a worklist in reverse postorder (postorder for
+      backward analyses), so that most of them are visited once per loop
+    - sets of facts (e.g., variables) are encoded as bitsets (ints)
+    - results are kept in "results" (while the function is not changed)
+    '''
+
+    def __init__(self, fnc):
+        self.version = fnc.version
+        self.results = {}
+
+        self.locs = sorted(fnc.locs())
+        self.succ = {}
+        self.pred = {loc: [] for loc in self.locs}
+        for loc in self.locs:
+            self.succ[loc] = []
+            for cond in (True, False):
+                nloc = fnc.loctrans[loc][cond]
+                if nloc is not None and nloc not in self.succ[loc]:
+                    self.succ[loc].append(nloc)
+                    self.pred[nloc].append(loc)
+
+        self.rpo = self.reversepostorder(fnc.initloc)
+
+        self.varindex = fnc.varindex()
+
+    def reversepostorder(self, initloc):
+        '''
+        Locations in reverse postorder of a DFS from initloc (unreachable
+        locations are put at the end)
+        '''
+
+        order = []
+        visited = set()
+        if initloc is not None:
+            visited.add(initloc)
+            stack = [(initloc, iter(self.succ[initloc]))]
+            while stack:
+                loc, succs = stack[-1]
+                for nloc in succs:
+                    if nloc not in visited:
+                        visited.add(nloc)
+                        stack.append((nloc, iter(self.succ[nloc])))
+                        break
+                else:
+                    stack.pop()
+                    order.append(loc)
+        order.reverse()
+
+        return order + [loc for loc in self.locs if loc not in visited]
+
+    def solve(self, gen, kill, backward=False, always=0):
+        '''
+        Solves a may-problem (with union):
+          after(loc) = gen(loc) | (before(loc) & ~kill(loc))
+          before(loc) = always | (union of after(l) for l predecessors
+                                  (successors if backward) of loc)
+        Returns (entry, exit) bitsets for each location, where entry is
+        before and exit is after (other way around if backward)
+        '''
+
+        if backward:
+            order = self.rpo[::-1]
+            prev, nexts = self.succ, self.pred
+        else:
+            order = self.rpo
+            prev, nexts = self.pred, self.succ
+
+        prio = {loc: i for (i, loc) in enumerate(order)}
+        before = {loc: always for loc in order}
+        after = {loc: gen[loc] for loc in order}
+
+        worklist = [(i, loc) for (i, loc) in enumerate(order)]
+        inlist = set(order)
+        while worklist:
+            _, loc = heappop(worklist)
+            inlist.discard(loc)
+
+            bits = always
+            for ploc in prev[loc]:
+                bits |= after[ploc]
+            before[loc] = bits
+
+            bits = gen[loc] | (bits & ~kill[loc])
+            if bits == after[loc]:
+                continue
+            after[loc] = bits
+
+            for nloc in nexts[loc]:
+                if nloc not in inlist:
+                    inlist.add(nloc)
+                    heappush(worklist, (prio[nloc], nloc))
+
+        if backward:
+            return (after, before)
+        return (before, after)
@@ -4,6 +4,7 @@ Python interpreter
 
 # Python imports
 import math
+import operator
 import string
 
 from copy import deepcopy
@@ -30,6 +31,69 @@ def eargs(fun):
 
     return wrap
 
+
+# Operators of Python's ast (by their names), evaluated by generated
+# methods (see makeoperator) instead of ones wrapped by eargs
+UNARY_OPERATORS = {
+    'Not': operator.not_,
+    'Invert': operator.invert,
+    'UAdd': operator.pos,
+    'USub': operator.neg,
+}
+
+BINARY_OPERATORS = {
+    'Add': operator.add,
+    'Sub': operator.sub,
+    'Mult': operator.mul,
+    'Div': operator.truediv,
+    'FloorDiv': operator.floordiv,
+    'Mod': operator.mod,
+    'Pow': operator.pow,
+    'LShift': operator.lshift,
+    'RShift': operator.rshift,
+    'BitAnd': operator.and_,
+    'BitOr': operator.or_,
+    'BitXor': operator.xor,
+    'Eq': operator.eq,
+    'NotEq': operator.ne,
+    'Lt': operator.lt,
+    'LtE': operator.le,
+    'Gt': operator.gt,
+    'GtE': operator.ge,
+    'Is': operator.is_,
+    'IsNot': operator.is_not,
+    'In': lambda x, y: x in y,
+    'NotIn': lambda x, y: x not in y,
+}
+
+
+def makeoperator(fnc, arity):
+    '''
+    Method evaluating an operator by fnc, specialized for its arity: args are
+    unpacked and checked for undefined values directly (as eargs does, but
+    without building and scanning a list of args)
+    '''
+
+    if arity == 1:
+        def execute_operator(self, f, mem):
+            x, = f.args
+            x = self.execute(x, mem)
+            if type(x) is UndefValue:
+                raise RuntimeErr('undefined value')
+            return fnc(x)
+
+    else:
+        def execute_operator(self, f, mem):
+            x, y = f.args
+            x = self.execute(x, mem)
+            y = self.execute(y, mem)
+            if type(x) is UndefValue or type(y) is UndefValue:
+                raise RuntimeErr('undefined value')
+            return fnc(x, y)
+
+    return execute_operator
+
+
 DEFAULT = object()
 
 class PyInterpreter(Interpreter):
@@ -38,10 +102,10 @@ class PyInterpreter(Interpreter):
     UNARY_OPS = set()
     DEFAULT_RETURN = None
 
-    def execute_Const(self, c, mem):
+    IMPURE_OPS = {'input'}
+
+    def decode_const(self, c):
 
-        c = c.value
-        
         # Undef
         if c == '?':
             return UndefValue()
@@ -151,10 +215,6 @@ class PyInterpreter(Interpreter):
         else:
             return tuple(t)
 
-    @eargs
-    def execute_Not(self, x):
-        return not x
-
     def execute_And(self, f, mem):
         x = self.execute(f.args[0], mem)
         if not x:
@@ -196,10 +256,6 @@ class PyInterpreter(Interpreter):
     def execute_round(self, *a):
         return round(*a)
 
-    @eargs
-    def execute_Pow(self, x, y):
-        return x ** y
-
     @eargs
     def execute_pow(self, *a):
         return pow(*a)
@@ -220,46 +276,6 @@ class PyInterpreter(Interpreter):
     def execute_max(self, *x):
         return max(*x)
 
-    @eargs
-    def execute_Invert(self, x):
-        return ~x
-
-    @eargs
-    def execute_UAdd(self, x):
-        return +x
-
-    @eargs
-    def execute_USub(self, x):
-        return -x
-
-    @eargs
-    def execute_BitAnd(self, x, y):
-        return x & y
-
-    @eargs
-    def execute_BitOr(self, x, y):
-        return x | y
-
-    @eargs
-    def execute_BitXor(self, x, y):
-        return x ^ y
-
-    @eargs
-    def execute_RShift(self, x, y):
-        return x >> y
-
-    @eargs
-    def execute_LShift(self, x, y):
-        return x << y
-
-    @eargs
-    def execute_Mod(self, x, y):
-        return x % y
-
-    @eargs
-    def execute_Add(self, x, y):
-        return x + y
-
     @eargs
     def execute___add__(self, x, y):
         return x + y
@@ -271,62 +287,6 @@ class PyInterpreter(Interpreter):
             y = list(y)
         return x + y
 
-    @eargs
-    def execute_Sub(self, x, y):
-        return x - y
-
-    @eargs
-    def execute_Div(self, x, y):
-        return x / y
-
-    @eargs
-    def execute_FloorDiv(self, x, y):
-        return x // y
-
-    @eargs
-    def execute_Mult(self, x, y):
-        return x * y
-
-    @eargs
-    def execute_Lt(self, x, y):
-        return x < y
-
-    @eargs
-    def execute_LtE(self, x, y):
-        return x <= y
-
-    @eargs
-    def execute_Gt(self, x, y):
-        return x > y
-
-    @eargs
-    def execute_GtE(self, x, y):
-        return x >= y
-
-    @eargs
-    def execute_Eq(self, x, y):
-        return x == y
-
-    @eargs
-    def execute_NotEq(self, x, y):
-        return x != y
-
-    @eargs
-    def execute_In(self, x, y):
-        return x in y
-
-    @eargs
-    def execute_NotIn(self, x, y):
-        return x not in y
-
-    @eargs
-    def execute_Is(self, x, y):
-        return x is y
-
-    @eargs
-    def execute_IsNot(self, x, y):
-        return x is not y
-
     @eargs
     def execute_GetElement(self, x, y):
         return x[y]
@@ -618,9 +578,12 @@ class PyInterpreter(Interpreter):
             return vars
 
         assert False, 'unsupported list of names'
-        
-    def convert(self, v, t):
-        return v
+
+
+for name, fnc in UNARY_OPERATORS.items():
+    setattr(PyInterpreter, 'execute_%s' % (name,), makeoperator(fnc, 1))
+for name, fnc in BINARY_OPERATORS.items():
+    setattr(PyInterpreter, 'execute_%s' % (name,), makeoperator(fnc, 2))
 
 
 addlanginter('py', PyInterpreter)
@@ -0,0 +1,147 @@
+'''
+Ranking of specifications by cheap features, used to select the most
+promising specifications before an (expensive) repair
+'''
+
+# Python imports
+from collections import Counter
+from difflib import SequenceMatcher
+
+# clara imports
+from .interpreter import RuntimeErr
+from .model import Op, VAR_OUT, prime
+
+
+def exprsize(e):
+    '''
+    Size (number of nodes) of an expression tree
+    '''
+    if isinstance(e, Op):
+        return 1 + sum(map(exprsize, e.args))
+    return 1
+
+
+class SpecRanker(object):
+    '''
+    Ranks specs w.r.t. an implementation using:
+    - structure signature (different structure cannot be repaired at all)
+    - number of variables of each function
+    - histogram of sizes of expressions
+    - similarity of the outputs on the inputs
+    Features of specs are computed once and remembered (by spec name).
+    '''
+
+    # Weight of the output (dis)similarity (in [0, 1]) compared to the
+    # differences in number of variables and expression sizes
+    OUTPUT_WEIGHT = 10
+
+    def __init__(self, inter, ins=None, args=None, entryfnc='main',
+                 budget=None):
+        self.inter = inter
+        self.ins = ins
+        self.args = args
+        self.entryfnc = entryfnc
+        self.budget = budget
+
+        self.cache = {}
+
+    def outputs(self, prog):
+        '''
+        Output of prog on each of the inputs (None if execution failed)
+        '''
+
+        ins = self.ins or [None for _ in range(len(self.args or []))]
+        args = self.args or [None for _ in range(len(ins))]
+
+        I = self.inter(entryfnc=self.entryfnc, budget=self.budget)
+        outs = []
+        for i, a in zip(ins, args):
+            try:
+                trace = I.run(prog, ins=i, args=a)
+                outs.append(str(trace[-1][2].get(prime(VAR_OUT), '')))
+            except RuntimeErr:
+                outs.append(None)
+        return outs
+
+    def features(self, prog, cache=True):
+        '''
+        Computes (or gets remembered) features of prog
+        '''
+
+        name = getattr(prog, 'name', None)
+        if cache and name in self.cache:
+            return self.cache[name]
+
+        sizes = Counter()
+        for fnc in prog.getfncs():
+            for loc in fnc.locs():
+                for _, expr in fnc.exprs(loc):
+                    sizes[exprsize(expr)] += 1
+
+        f = {
+            'struct': prog.structkey(),
+            'vars': {fnc.name: len(fnc.getvars()) for fnc in prog.getfncs()},
+            'sizes': sizes,
+            'outs': self.outputs(prog),
+        }
+
+        if cache and name is not None:
+            self.cache[name] = f
+        return f
+
+    def distance(self, f1, f2):
+        '''
+        Distance between features (lower is more similar)
+        '''
+
+        if f1['struct'] != f2['struct']:
+            return (1, 0.0)
+
+        dist = sum(abs(n - f2['vars'].get(fnc, 0))
+                   for (fnc, n) in f1['vars'].items())
+
+        for size in set(f1['sizes']) | set(f2['sizes']):
+            dist += abs(f1['sizes'][size] - f2['sizes'][size])
+
+        for o1, o2 in zip(f1['outs'], f2['outs']):
+            if o1 is None or o2 is None:
+                sim = 1.0 if o1 == o2 else 0.0
+            else:
+                sim = SequenceMatcher(None, o1, o2).ratio()
+            dist += self.OUTPUT_WEIGHT * (1.0 - sim)
+
+        return (0, dist)
+
+    def rank(self, impl, specs):
+        '''
+        Sorts specs from the most to the least promising one
+        '''
+
+        fi = self.features(impl, cache=False)
+        return sorted(specs,
+                      key=lambda spec: self.distance(fi, self.features(spec)))
+
+    def topk(self, impl, specs, k):
+        '''
+        Selects k most promising specs
+        '''
+
+        return self.rank(impl, specs)[:k]
+
+    def recall(self, cases, ks):
+        '''
+        Recall of top-k selection on held-out cases, for each k in ks:
+        cases is a list of (impl, specs, best), where best is the name of the
+        spec selected by the repair on all specs
+        '''
+
+        ranks = []
+        for impl, specs, best in cases:
+            names = [spec.name for spec in self.rank(impl, specs)]
+            ranks.append(names.index(best))
+
+        if not ranks:
+            return {k: None for k in ks}
+
+        return {k: sum(1 for r in ranks if r < k) / float(len(ranks))
+                for k in ks}
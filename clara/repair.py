@@ -10,9 +10,9 @@ import time
 from zss import Node, simple_distance as tree_distance
 
 # clara imports
-from .common import debug, equals
-from .interpreter import RuntimeErr, isundef
-from .model import isprimed, unprime, prime
+from .common import OutputBuffer, debug, equals
+from .interpreter import Budget, RuntimeErr, isundef, runmany
+from .model import bitcount, isprimed, unprime, prime
 from .model import SPECIAL_VARS, VAR_IN, VAR_OUT, VAR_RET
 from .model import Var, Const, Op
 from .matching import Matching
@@ -26,10 +26,6 @@ class Timeout(Exception):
     pass
 
 
-def unprimes(x):
-    return unprime(x) if isprimed(x) else x
-
-
 def label_dist(m):
     def f(l1, l2):
         if not l1:
@@ -73,11 +69,17 @@ class RepairResult(object):
 class Repair(object):
 
     def __init__(self, timeout=60, verbose=False, solver=None,
-                 allowsuboptimal=True, cleanstrings=False):
+                 allowsuboptimal=True, cleanstrings=False, cachetrace=False,
+                 cancelled=None, budget=None, memo=False, pool=None):
         self.starttime = None
         self.timeout = timeout
         self.verbose = verbose
         self.cleanstrings = cleanstrings
+        self.cachetrace = cachetrace
+        self.cancelled = cancelled  # Callable, repair is stopped when True
+        self.budget = budget  # Budget of executions (None for default)
+        self.memo = memo  # Memoize calls of pure functions in executions
+        self.pool = pool  # Pool running executions on inputs (None: serially)
 
         if solver is None:
             from .ilp import Solver
@@ -85,6 +87,8 @@ class Repair(object):
         self.solver = solver(verbose=verbose, allowsuboptimal=allowsuboptimal)
 
     def lefttime(self):
+        if self.cancelled is not None and self.cancelled():
+            return -1
         if not self.timeout:
             return 365 * (24 * 3600)  # A year
         return self.timeout - (time.time() - self.starttime)
@@ -113,19 +117,40 @@ class Repair(object):
         if not args:
             args = [None for _ in range(len(ins))]
 
-        I = inter(entryfnc=entryfnc)
+        # Reuse a trace computed earlier for the same inputs and budget (if
+        # any), since an execution may not fit in another budget
+        budget = self.budget or Budget()
+        key = (inter.__name__, repr(ins), repr(args), entryfnc,
+               (budget.steps, budget.iters, budget.evals, budget.depth))
+        if self.cachetrace:
+            cached = P.getmeta('trace')
+            if cached is not None and cached[0] == key:
+                return cached[1]
+
+        R = runmany(inter, P, ins, args, pool=self.pool, entryfnc=entryfnc,
+                    timeout=self.timeout or None, budget=self.budget,
+                    memo=self.memo)
         T = {}
-        for i, a in zip(ins, args):
-            t = I.run(P, ins=i, args=a)
-
-            # Split trace w.r.t. fncs and locs
-            for (fnc, loc, mem) in t:
+        for t, ex in R:
+            if ex is not None:
+                raise ex
+
+            # Split trace w.r.t. fncs and locs (scanning its columns); if
+            # the trace was spilled, memories stay views of its columns
+            if t.spilled:
+                mems = (mem for (_, _, mem) in t)
+            else:
+                mems = t.mems()
+            for f, loc, mem in zip(t.fncs, t.locs, mems):
+                fnc = t.fncnames[f]
                 if fnc not in T:
                     T[fnc] = {}
                 if loc not in T[fnc]:
                     T[fnc][loc] = []
                 T[fnc][loc].append(mem)
 
+        if self.cachetrace:
+            P.addmeta('trace', (key, T))
         return T
 
     def repair(self, P, Q, inter, ins=None, args=None, entryfnc=None,
@@ -149,7 +174,7 @@ class Repair(object):
         self.trace = self.gettrace(P, inter, ins, args, entryfnc)
 
         # (3) Repair each fnc sepearately
-        self.inter = inter()
+        self.inter = inter(budget=self.budget)
         results = {}
         for fnc1 in P.getfncs():
             fnc2 = Q.getfnc(fnc1.name)
@@ -269,8 +294,8 @@ class Repair(object):
 
                     self.ER[loc1][var1] = []
                     self.TR[loc1][var1] = []
-                    for expr in f1.repair_exprs[loc1][var1]:
-                        self.ER[loc1][var1].append((expr, expr.src))
+                    for expr, src in f1.repair_exprs[loc1][var1].items():
+                        self.ER[loc1][var1].append((expr, src))
                         self.TR[loc1][var1].append(self.totree(expr))
                 else:
                     self.ER[loc1][var1] = [(self.E1[loc1][var1], None)]
@@ -303,23 +328,25 @@ class Repair(object):
     def distance(self, t1, t2, m):
         return tree_distance(t1, t2, label_dist=label_dist(m))
 
-    def one_to_ones(self, S1, S2, m1, m2, taken=None):
+    def one_to_ones(self, S1, S2, m1, m2, taken=0):
+        '''
+        Generates one-to-one mappings of S1 to S2, where taken is a bitmask of
+        (indices of) elements of S2 already mapped to ('*' can be mapped to
+        many times)
+        '''
 
         if self.lefttime() < 0:
             raise Timeout()
 
-        if taken is None:
-            taken = set()
-
-        if len(S1) == 0 or len(S2) == len(taken):
+        if len(S1) == 0 or len(S2) == bitcount(taken):
             yield []
             return
 
         s1, SS1 = S1[0], S1[1:]
 
-        for s2 in S2:
+        for i, s2 in enumerate(S2):
 
-            if s2 in taken:
+            if taken & (1 << i):
                 continue
 
             if s1 == m1 and s2 != m2:
@@ -345,8 +372,7 @@ class Repair(object):
             if s2 == '*':
                 newtaken = taken
             else:
-                newtaken = set(taken)
-                newtaken.add(s2)
+                newtaken = taken | (1 << i)
 
             for m in self.one_to_ones(SS1, S2, m1, m2, newtaken):
                 m = list(m)
@@ -356,23 +382,20 @@ class Repair(object):
     def getorder(self, var, expr, m):
         if var == '*' or var in SPECIAL_VARS:
             return []
-        vars = expr.vars()
         order = []
-        for var2 in vars:
-            if isprimed(var2):
-                var2 = unprime(var2)
-                var2 = m[var2]
-                if var2 == '*':
-                    continue
-                if var == var2:
-                    return None
-                order.append((var2, var))
-            else:
-                var2 = m[var2]
-                if var2 == '*':
-                    continue
-                if var != var2 and var2 != '*':
-                    order.append((var, var2))
+        for var2 in expr.postvars():
+            var2 = m[var2]
+            if var2 == '*':
+                continue
+            if var == var2:
+                return None
+            order.append((var2, var))
+        for var2 in expr.prevars():
+            var2 = m[var2]
+            if var2 == '*':
+                continue
+            if var != var2 and var2 != '*':
+                order.append((var, var2))
         order.sort()
         return order
 
@@ -383,7 +406,7 @@ class Repair(object):
         isid = (isinstance(expr1, Var) and expr1.name == var1
                 and expr1.primed == False)
         tree1 = self.T1[loc1][var1]
-        vars1 = list(set(map(unprimes, expr1.vars())) | set([var1]))
+        vars1 = list(expr1.varnames() | set([var1]))
         vars1.sort()
 
         V1 = list(self.V1 - set(['-']))
@@ -417,7 +440,7 @@ class Repair(object):
 
             expr2 = self.E2[loc2][var2]
             tree2 = self.T2[loc2][var2]
-            vars2 = list(set(map(unprimes, expr2.vars())) | set([var2]))
+            vars2 = list(expr2.varnames() | set([var2]))
             vars2.sort()
 
             # (0) Deletes are special
@@ -440,16 +463,18 @@ class Repair(object):
                         if isundef(val1) and (var1 != VAR_RET):
                             continue
 
-                        if isinstance(val1, str) and self.cleanstrings:
-                            val1 = val1.strip()
+                        if (isinstance(val1, (str, OutputBuffer))
+                                and self.cleanstrings):
+                            val1 = str(val1).strip()
 
                         mem2 = {v2: mem1.get(v1) for (v1, v2) in m}
                         mem2.update({prime(v2): mem1.get(prime(v1))
                                      for (v1, v2) in m})
                         try:
-                            val2 = self.inter.execute(expr2, mem2)
-                            if isinstance(val2, str) and self.cleanstrings:
-                                val2 = val2.strip()
+                            val2 = self.inter.evaluate(expr2, mem2)
+                            if (isinstance(val2, (str, OutputBuffer))
+                                    and self.cleanstrings):
+                                val2 = str(val2).strip()
 
                             if not equals(val2, val1):
                                 ok = False
@@ -474,7 +499,7 @@ class Repair(object):
 
                 risid = (isinstance(rexpr, Var) and rexpr.name == var1
                          and rexpr.primed == False)
-                rvars = list(set(map(unprimes, rexpr.vars())) | set([var1]))
+                rvars = list(rexpr.varnames() | set([var1]))
 
                 for m in self.one_to_ones(rvars, V2, var1, var2):
                     order = self.getorder(var2, rexpr, dict(m))
@@ -0,0 +1,115 @@
+'''
+Long-running repair server
+- keeps clustered specs (and their traces) and a warm pool in memory
+- answers repair requests for new submissions over HTTP
+'''
+
+# Python imports
+import json
+import traceback
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# clara imports
+from .feedback import FeedGen, Feedback
+from .feedback_repair import RepairFeedback
+from .parser import ParseError, NotSupported
+
+
+class RepairHandler(BaseHTTPRequestHandler):
+    '''
+    Handles requests:
+    - GET /status - names of the loaded specs
+    - POST /repair - body is JSON {"src": <code>}, response is the feedback
+    '''
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path != '/status':
+            self.reply(404, {'error': 'unknown path: %s' % (self.path,)})
+            return
+
+        self.reply(200, {
+            'lang': self.server.clara.lang,
+            'specs': [spec.name for spec in self.server.specs],
+        })
+
+    def do_POST(self):
+        if self.path != '/repair':
+            self.reply(404, {'error': 'unknown path: %s' % (self.path,)})
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            req = json.loads(self.rfile.read(length).decode('utf-8'))
+            src = req['src']
+        except (ValueError, KeyError, TypeError) as ex:
+            self.reply(400, {'error': 'bad request: %s' % (ex,)})
+            return
+
+        try:
+            self.reply(200, self.server.repair(src, req.get('name')))
+        except (ParseError, NotSupported) as ex:
+            self.reply(400, {'error': 'cannot parse: %s' % (ex,)})
+        except Exception:
+            self.reply(500, {'error': traceback.format_exc()})
+
+
+class RepairServer(HTTPServer):
+    '''
+    HTTP server answering repair requests against a fixed set of specs
+    '''
+
+    def __init__(self, clara, specs, address, poolsize=None):
+        HTTPServer.__init__(self, address, RepairHandler)
+
+        assert len(specs) > 0, 'No specs!'
+
+        self.clara = clara
+        self.specs = list(specs)
+
+        # Pool is created once and kept (with specs loaded) between requests
+        self.feedgen = FeedGen(poolsize=poolsize, feedmod=RepairFeedback,
+                               timeout=clara.timeout,
+                               earlystop=clara.earlystop,
+                               budget=clara.budget)
+        self.feedgen.preload(self.specs)
+
+    def repair(self, src, name=None):
+        '''
+        Generates feedback for a single submission
+        '''
+
+        impl = self.clara.process_code(src, name or '<submission>')
+        feed = self.clara.generate_feedback(impl, self.specs,
+                                            feedgen=self.feedgen)
+
+        res = {
+            'status': feed.statusstr(),
+            'error': feed.error,
+            'spec': feed.spec.name,
+            'cost': feed.cost,
+            'feedback': [],
+        }
+
+        if feed.status == Feedback.STATUS_REPAIRED:
+            maxcost = self.clara.max_cost
+            if maxcost > 0 and feed.cost > maxcost:
+                res['error'] = 'max cost exceeded (%d > %d)' % (
+                    feed.cost, maxcost)
+            else:
+                res['feedback'] = list(feed.feedback)
+
+        return res
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if self.feedgen.pool is not None:
+            self.feedgen.pool.terminate()